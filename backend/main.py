@@ -1,14 +1,19 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import HTMLResponse
-from pydantic import BaseModel
+from fastapi.responses import HTMLResponse, JSONResponse, Response, FileResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, ValidationError
 from typing import Optional
-import sqlite3, hashlib, hmac, jwt, os, secrets, base64
+import sqlite3, hashlib, hmac, jwt, os, secrets, re, time, asyncio, threading, contextvars, gzip, shutil, fcntl, json, socket
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, Future
 from datetime import datetime, timedelta
+from PIL import Image, ImageOps
 
 app = FastAPI(title="TradDesk API", version="3.1.0")
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
 JWT_SECRET     = os.getenv("JWT_SECRET", "tradesk_secret_2026")
 # DEPLOY_VERSION: change this value to force all users to re-login immediately
@@ -18,17 +23,317 @@ DEPLOY_VERSION = os.getenv("DEPLOY_VERSION", "v6")  # bumped → invalidates all
 _EFFECTIVE_SECRET = f"{JWT_SECRET}_{DEPLOY_VERSION}"
 DB_PATH        = os.getenv("DB_PATH", "tradesk.db")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "tradesk_admin_2026")
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24")) * 3600
 bearer_scheme  = HTTPBearer()
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA foreign_keys=ON")
-    return conn
+# ── Shops (tenants) & connection pools ───────────────────────
+# Every shop (branch) has its own SQLite file, so branches never share a write lock.
+# "main" keeps using DB_PATH; other shops live in TENANT_DIR/<shop>.db.
+# The shop is carried in the JWT ("shop" claim) and picked per request by tenant_middleware.
+MAIN_SHOP        = "main"
+SHOPS            = [s.strip() for s in os.getenv("SHOPS", MAIN_SHOP).split(",") if s.strip()]
+if MAIN_SHOP not in SHOPS: SHOPS.insert(0, MAIN_SHOP)
+TENANT_DIR       = os.getenv("TENANT_DIR", os.path.dirname(os.path.abspath(DB_PATH)))
+TENANT_POOL_MAX  = int(os.getenv("TENANT_POOL_MAX", "16"))   # shops kept open at once (LRU)
+POOL_SIZE        = int(os.getenv("DB_POOL_SIZE", "8"))       # idle connections kept per shop
+WAL_MAX_BYTES    = int(os.getenv("WAL_MAX_MB", "64")) * 1024 * 1024   # WAL is truncated back to this size
+SHOP_NAME_RE     = re.compile(r"^[a-z0-9_-]{1,40}$")
+current_shop     = contextvars.ContextVar("current_shop", default=MAIN_SHOP)
+request_deadline = contextvars.ContextVar("request_deadline", default=None)   # (monotonic deadline, gate), see admission
 
-def init_db():
-    with get_db() as db:
+def shop_db_path(shop):
+    if shop == MAIN_SHOP: return DB_PATH
+    return os.path.join(TENANT_DIR, f"{shop}.db")
+
+def valid_shop_name(shop):
+    """Well-formed, and not a branch whose file would be the main shop's DB_PATH (e.g. "tradesk")."""
+    return shop == MAIN_SHOP or (bool(SHOP_NAME_RE.match(shop)) and
+                                 os.path.abspath(shop_db_path(shop)) != os.path.abspath(DB_PATH))
+
+for _shop in SHOPS:
+    if not valid_shop_name(_shop): raise RuntimeError(f"SHOPS: '{_shop}' is not a valid shop name or would share {DB_PATH}")
+
+def check_shop(shop):
+    shop = (shop or MAIN_SHOP).lower()
+    if shop not in SHOPS or not valid_shop_name(shop): raise HTTPException(404, f"Unknown shop '{shop}'")
+    return shop
+
+class TenantPool:
+    """Idle-connection pool for one shop's database. Checked-out connections are
+    closed on return once the pool has been evicted."""
+    def __init__(self, shop):
+        self.shop, self.path = shop, shop_db_path(shop)
+        self.idle, self.lock, self.closed = [], threading.Lock(), False
+        conn = self._open()
+        init_db(conn)
+        self.idle.append(conn)
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")   # only takes effect on a new file (else via a 'compact' job)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA journal_size_limit={WAL_MAX_BYTES}")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def acquire(self):
+        with self.lock:
+            if self.idle: return self.idle.pop()
+        return self._open()
+
+    def release(self, conn):
+        if conn.in_transaction: conn.rollback()
+        with self.lock:
+            if not self.closed and len(self.idle) < POOL_SIZE:
+                self.idle.append(conn); return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            try: conn.execute("PRAGMA optimize")
+            except sqlite3.Error: pass
+            conn.close()
+
+_pools = OrderedDict()          # shop -> TenantPool, most recently used last
+_pools_opening = {}             # shop -> Future of the pool one thread is opening
+_pools_lock = threading.Lock()
+
+def tenant_pool(shop):
+    """Pool for a shop, opened (and migrated) on first use; least recently used shops are closed.
+    Opening runs outside _pools_lock: a long first-open migration of one shop only makes
+    requests for that shop wait, not every shop."""
+    with _pools_lock:
+        pool = _pools.get(shop)
+        if pool:
+            _pools.move_to_end(shop); return pool
+        opening = _pools_opening.get(shop)
+        if opening is None: opening = _pools_opening[shop] = Future(); owner = True
+        else: owner = False
+    if not owner: return opening.result()   # re-raises if that open failed
+    try: pool = TenantPool(shop)
+    except BaseException as e:
+        with _pools_lock: _pools_opening.pop(shop, None)
+        opening.set_exception(e); raise
+    with _pools_lock:
+        _pools_opening.pop(shop, None)
+        _pools[shop] = pool
+        evicted = [_pools.popitem(last=False)[1] for _ in range(len(_pools) - TENANT_POOL_MAX)]
+    opening.set_result(pool)
+    for old in evicted: old.close()
+    return pool
+
+@contextmanager
+def get_db(shop=None):
+    """Pooled connection for `shop` (default: the current request's shop).
+    Commits on success and rolls back on error, like `with sqlite3.connect(...)`."""
+    shop = shop or current_shop.get()
+    pool = tenant_pool(shop)
+    conn = pool.acquire()
+    changes = conn.total_changes
+    budget = request_deadline.get()
+    if budget:   # abort SQLite work once the request's deadline has passed
+        conn.set_progress_handler(lambda: time.monotonic() > budget[0], 10000)
+    try:
+        yield conn
+        conn.commit()
+    except sqlite3.OperationalError as e:
+        conn.rollback()
+        if budget and time.monotonic() > budget[0]:
+            budget[1].counts["deadline_exceeded"] += 1
+            raise HTTPException(503, "Request exceeded its time budget", headers={"Retry-After": "5"}) from e
+        raise
+    except BaseException:
+        conn.rollback(); raise
+    finally:
+        if budget: conn.set_progress_handler(None, 0)
+        if conn.total_changes != changes: response_cache.touch(shop)
+        pool.release(conn)
+
+# ── Response cache ────────────────────────────────────────────
+# Per-worker cache of rendered JSON for hot reads (catalog, users, analytics), keyed by
+# path + query params + role. Triggers bump a per-table generation in table_versions on
+# every write, and an entry is reused while the generations of the tables it was built
+# from are unchanged. Writes in this worker mark the shop dirty (see get_db); writes in
+# other workers are noticed by polling PRAGMA data_version on a watcher connection at most
+# every CACHE_POLL_MS — between polls hits never touch SQLite. Memory is capped by LRU.
+CACHED_TABLES   = ("users","suppliers","raw_items","purchases","purchase_payments","products",
+                   "product_ingredients","product_charges","customers","sales","sale_payments","order_items",
+                   "stock_alerts")
+# Tables whose row changes are logged for /api/sync deltas (see init_db)
+SYNC_TABLES     = ("suppliers","products","customers","sales","order_items","sale_payments","purchases","purchase_payments",
+                   "stock_alerts")
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_MB", "32")) * 1024 * 1024
+CACHE_POLL_SEC  = int(os.getenv("CACHE_POLL_MS", "100")) / 1000
+
+class ResponseCache:
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.shops   = {}               # shop -> {"conn", "data_version", "versions", "checked", "dirty"}
+        self.entries = OrderedDict()    # (shop, key) -> (generations, body), least recently used first
+        self.bytes   = 0
+        self.counts  = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _versions(self, shop):
+        st = self.shops.get(shop)
+        if st is None:
+            tenant_pool(shop)   # schema + triggers exist before we watch
+            conn = sqlite3.connect(shop_db_path(shop), check_same_thread=False)
+            st = self.shops[shop] = {"conn": conn, "data_version": None, "versions": {}, "checked": 0.0, "dirty": True}
+        now = time.monotonic()
+        if st["dirty"] or now - st["checked"] >= CACHE_POLL_SEC:
+            st["dirty"] = False
+            dv = st["conn"].execute("PRAGMA data_version").fetchone()[0]
+            if dv != st["data_version"]:
+                st["versions"] = dict(st["conn"].execute("SELECT name, version FROM table_versions").fetchall())
+                st["data_version"] = dv
+            st["checked"] = now
+        return st["versions"]
+
+    def version(self, shop, table):
+        """Current write generation of one table (polled like cache lookups)."""
+        with self.lock: return self._versions(shop).get(table, 0)
+
+    def touch(self, shop):
+        """A connection of this worker wrote to `shop` — re-check generations on the next read."""
+        st = self.shops.get(shop)
+        if st: st["dirty"] = True
+
+    def get(self, key, tables, loader):
+        """JSON response for loader(), reused until one of `tables` is written."""
+        ck = (current_shop.get(), key)
+        with self.lock:
+            versions = self._versions(ck[0])
+            tag = tuple(versions.get(t, 0) for t in tables)
+            hit = self.entries.get(ck)
+            if hit and hit[0] == tag:
+                self.entries.move_to_end(ck); self.counts["hits"] += 1
+                return Response(hit[1], media_type="application/json", headers={"X-Cache": "HIT"})
+            self.counts["misses"] += 1
+        body = JSONResponse(loader()).body   # tagged with generations read *before* loading
+        with self.lock:
+            old = self.entries.pop(ck, None)
+            if old: self.bytes -= len(old[1])
+            if len(body) <= CACHE_MAX_BYTES // 4:     # one huge list must not flush everything else
+                self.entries[ck] = (tag, body); self.bytes += len(body)
+                while self.bytes > CACHE_MAX_BYTES:
+                    _, (_, b) = self.entries.popitem(last=False)
+                    self.bytes -= len(b); self.counts["evictions"] += 1
+        return Response(body, media_type="application/json", headers={"X-Cache": "MISS"})
+
+    def forget(self, shop):
+        with self.lock:
+            st = self.shops.pop(shop, None)
+            for ck in [ck for ck in self.entries if ck[0] == shop]:
+                self.bytes -= len(self.entries.pop(ck)[1])
+        if st: st["conn"].close()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counts["hits"] + self.counts["misses"]
+            return {**self.counts, "entries": len(self.entries), "bytes": self.bytes, "max_bytes": CACHE_MAX_BYTES,
+                    "hit_rate": round(self.counts["hits"]/lookups, 3) if lookups else None}
+
+response_cache = ResponseCache()
+
+def cache_key(request, user):
+    params = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+    return f"{request.url.path}?{params}|{user.get('role')}"
+
+# ── Daily aggregates ──────────────────────────────────────────
+# daily_totals holds per-day, per-key sums for each leaderboard dimension, kept current by
+# triggers on the source rows (a write adds or subtracts its own contribution), so
+# leaderboards read a few rows per day instead of grouping the full history.
+# dim -> (source alias, FROM/WHERE template, day, key, label, amount, qty); {r} is NEW/OLD.
+DAILY_DIMS = {
+    "customer": ("sales", "WHERE {r}.is_return=0", "{r}.date", "{r}.customer_name", "{r}.customer_name", "{r}.total", "0"),
+    "staff":    ("sales", "WHERE {r}.is_return=0", "{r}.date", "CAST({r}.added_by AS TEXT)", "NULL", "{r}.total", "0"),
+    "product":  ("sales", "FROM order_items oi WHERE oi.sale_id={r}.id AND {r}.is_return=0", "{r}.date",
+                 "COALESCE(CAST(oi.product_id AS TEXT), 'name:'||oi.product_name)", "oi.product_name", "oi.total", "oi.qty"),
+    "line":     ("order_items", "FROM sales s WHERE s.id={r}.sale_id AND s.is_return=0", "s.date",
+                 "COALESCE(CAST({r}.product_id AS TEXT), 'name:'||{r}.product_name)", "{r}.product_name", "{r}.total", "{r}.qty"),
+    "supplier": ("purchases", "WHERE 1", "{r}.date", "{r}.supplier_name", "{r}.supplier_name", "{r}.total", "{r}.qty"),
+}
+DAILY_TRIGGER_COLS = {"sales": "is_return,date,customer_name,added_by,total",
+                      "order_items": "sale_id,product_id,product_name,qty,total",
+                      "purchases": "date,supplier_name,total,qty"}
+
+def _daily_upsert(dim, ref, sign):
+    _, where, day, key, label, amount, qty = (x.format(r=ref) for x in DAILY_DIMS[dim])
+    return (f"INSERT INTO daily_totals(dim,day,key,label,amount,qty,cnt) "
+            f"SELECT '{'product' if dim == 'line' else dim}', substr({day},1,10), {key}, {label}, "
+            f"{sign}*{amount}, {sign}*{qty}, {sign} {where} "
+            "ON CONFLICT(dim,day,key) DO UPDATE SET amount=amount+excluded.amount, qty=qty+excluded.qty, "
+            "cnt=cnt+excluded.cnt, label=CASE WHEN excluded.cnt>0 THEN excluded.label ELSE label END;")
+
+def daily_triggers():
+    """(name, sql) for every trigger maintaining daily_totals. A sale's lines are subtracted BEFORE
+    the sale is deleted: once it is gone, its lines (deleted first or by the FK cascade) no longer
+    join to a sale, so whichever goes first takes the lines' contribution with it."""
+    for table, cols in DAILY_TRIGGER_COLS.items():
+        dims = [d for d, spec in DAILY_DIMS.items() if spec[0] == table]
+        ops = {"insert": ("AFTER INSERT", [("NEW", 1)], dims),
+               "delete": ("AFTER DELETE", [("OLD", -1)], [d for d in dims if d != "product"]),
+               "before_delete": ("BEFORE DELETE", [("OLD", -1)], [d for d in dims if d == "product"]),
+               "update": (f"AFTER UPDATE OF {cols}", [("OLD", -1), ("NEW", 1)], dims)}
+        for name, (event, parts, on) in ops.items():
+            if not on: continue
+            body = " ".join(_daily_upsert(d, ref, sign) for ref, sign in parts for d in on)
+            yield f"trg_{table}_{name}_daily", f"CREATE TRIGGER trg_{table}_{name}_daily {event} ON {table} BEGIN {body} END"
+
+def rebuild_daily_totals(db):
+    """Recompute daily_totals from the source tables (idempotent)."""
+    db.execute("DELETE FROM daily_totals")
+    for dim, (table, where, day, key, label, amount, qty) in DAILY_DIMS.items():
+        if dim == "product": continue   # lines are covered by the order_items source
+        cols = [x.format(r="src") for x in (day, key, label, amount, qty)]
+        where = where.format(r="src")
+        source = f"FROM {table} src, {where[5:]}" if where.startswith("FROM ") else f"FROM {table} src {where}"
+        db.execute(f"INSERT INTO daily_totals(dim,day,key,label,amount,qty,cnt) "
+                   f"SELECT '{'product' if dim == 'line' else dim}', substr({cols[0]},1,10) as d, {cols[1]} as k, MAX({cols[2]}), "
+                   f"SUM({cols[3]}), SUM({cols[4]}), COUNT(*) {source} GROUP BY d, k")
+    db.execute("INSERT OR REPLACE INTO meta(key,value) VALUES('daily_totals_built', datetime('now'))")
+
+# ── Stock levels ──────────────────────────────────────────────
+# raw_items.available (purchased minus used in products) follows every purchase and
+# product_ingredients write, and products.qty_available is updated by sales, orders, returns
+# and deletes. Triggers on both compare the new level against low_stock_threshold and the
+# item's latest alert, logging each crossing (state 'low' or back to 'ok') in stock_alerts.
+RAW_AVAILABLE_SQL = ("(SELECT COALESCE(SUM(qty),0) FROM purchases WHERE item={name}) - "
+                     "(SELECT COALESCE(SUM(qty),0) FROM product_ingredients WHERE item_name={name})")
+STOCK_ALERT_SOURCES = {"raw_item": ("raw_items", "available"), "product": ("products", "qty_available")}
+
+def stock_triggers():
+    moves = {"purchases": ("item", "qty", "+"), "product_ingredients": ("item_name", "qty", "-")}
+    for table, (name, qty, sign) in moves.items():
+        undo = "-" if sign == "+" else "+"
+        add  = f"UPDATE raw_items SET available=available{sign}NEW.{qty} WHERE name=NEW.{name};"
+        sub  = f"UPDATE raw_items SET available=available{undo}OLD.{qty} WHERE name=OLD.{name};"
+        yield f"CREATE TRIGGER IF NOT EXISTS trg_{table}_insert_stock AFTER INSERT ON {table} BEGIN {add} END"
+        yield f"CREATE TRIGGER IF NOT EXISTS trg_{table}_delete_stock AFTER DELETE ON {table} BEGIN {sub} END"
+        yield f"CREATE TRIGGER IF NOT EXISTS trg_{table}_update_stock AFTER UPDATE OF {name},{qty} ON {table} BEGIN {sub} {add} END"
+    for kind, (table, col) in STOCK_ALERT_SOURCES.items():
+        low    = lambda r: f"(COALESCE({r}.low_stock_threshold,0)>0 AND {r}.{col}<={r}.low_stock_threshold)"
+        latest = lambda r: f"(SELECT state FROM stock_alerts WHERE kind='{kind}' AND ref_id={r}.id ORDER BY id DESC LIMIT 1)"
+        log    = lambda r, state: (f"INSERT INTO stock_alerts(kind,ref_id,name,level,threshold,state) "
+                                   f"VALUES('{kind}',{r}.id,{r}.name,{r}.{col},{r}.low_stock_threshold,'{state}');")
+        yield (f"CREATE TRIGGER IF NOT EXISTS trg_{table}_low_alert AFTER UPDATE OF {col},low_stock_threshold ON {table} "
+               f"WHEN {low('NEW')} AND COALESCE({latest('NEW')},'ok')!='low' BEGIN {log('NEW','low')} END")
+        yield (f"CREATE TRIGGER IF NOT EXISTS trg_{table}_ok_alert AFTER UPDATE OF {col},low_stock_threshold ON {table} "
+               f"WHEN NOT {low('NEW')} AND {latest('NEW')}='low' BEGIN {log('NEW','ok')} END")
+        yield f"CREATE TRIGGER IF NOT EXISTS trg_{table}_delete_alert AFTER DELETE ON {table} WHEN {latest('OLD')}='low' BEGIN {log('OLD','ok')} END"
+    # A new raw item has no stock until the purchase that creates it lands, so only products alert on insert
+    yield ("CREATE TRIGGER IF NOT EXISTS trg_products_insert_alert AFTER INSERT ON products "
+           "WHEN COALESCE(NEW.low_stock_threshold,0)>0 AND NEW.qty_available<=NEW.low_stock_threshold BEGIN "
+           "INSERT INTO stock_alerts(kind,ref_id,name,level,threshold,state) "
+           "VALUES('product',NEW.id,NEW.name,NEW.qty_available,NEW.low_stock_threshold,'low'); END")
+
+def init_db(conn):
+    """Create / migrate the schema on a freshly opened shop database."""
+    with conn as db:
         db.executescript("""
             CREATE TABLE IF NOT EXISTS users (
                 id              INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -53,6 +358,7 @@ def init_db():
                 name                TEXT NOT NULL UNIQUE,
                 unit                TEXT NOT NULL DEFAULT 'units',
                 low_stock_threshold REAL DEFAULT 0,
+                available           REAL NOT NULL DEFAULT 0,
                 created_at          TEXT DEFAULT (datetime('now'))
             );
             CREATE TABLE IF NOT EXISTS purchases (
@@ -90,6 +396,7 @@ def init_db():
                 defined_price REAL NOT NULL,
                 unit          TEXT NOT NULL DEFAULT 'pcs',
                 qty_available REAL NOT NULL DEFAULT 0,
+                low_stock_threshold REAL NOT NULL DEFAULT 0,
                 image_data    TEXT,
                 image_name    TEXT,
                 is_active     INTEGER NOT NULL DEFAULT 1,
@@ -152,6 +459,51 @@ def init_db():
                 amount      REAL NOT NULL,
                 created_at  TEXT DEFAULT (datetime('now'))
             );
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                user_id     INTEGER NOT NULL,
+                key         TEXT NOT NULL,
+                path        TEXT NOT NULL,
+                body_hash   TEXT NOT NULL,
+                status      INTEGER,
+                response    BLOB,
+                created_at  REAL NOT NULL,
+                PRIMARY KEY (user_id, key)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS images (
+                id          INTEGER PRIMARY KEY AUTOINCREMENT,
+                token       TEXT NOT NULL UNIQUE,
+                owner       TEXT NOT NULL,
+                owner_id    INTEGER NOT NULL,
+                file_name   TEXT,
+                mime        TEXT NOT NULL,
+                bytes       INTEGER NOT NULL,
+                width       INTEGER,
+                height      INTEGER,
+                status      TEXT NOT NULL DEFAULT 'pending',
+                error       TEXT,
+                created_at  TEXT DEFAULT (datetime('now'))
+            );
+            CREATE INDEX IF NOT EXISTS idx_images_owner ON images(owner, owner_id);
+            CREATE TABLE IF NOT EXISTS jobs (
+                id               INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind             TEXT NOT NULL,
+                params           TEXT NOT NULL DEFAULT '{}',
+                priority         INTEGER NOT NULL DEFAULT 0,
+                status           TEXT NOT NULL DEFAULT 'queued',
+                progress         REAL NOT NULL DEFAULT 0,
+                message          TEXT,
+                result           TEXT,
+                error            TEXT,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                attempts         INTEGER NOT NULL DEFAULT 0,
+                worker           TEXT,
+                heartbeat_at     REAL,
+                added_by         INTEGER REFERENCES users(id),
+                created_at       TEXT DEFAULT (datetime('now')),
+                started_at       TEXT,
+                finished_at      TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs(priority DESC, id) WHERE status='queued';
             CREATE TABLE IF NOT EXISTS order_items (
                 id          INTEGER PRIMARY KEY AUTOINCREMENT,
                 sale_id     INTEGER NOT NULL REFERENCES sales(id) ON DELETE CASCADE,
@@ -174,16 +526,130 @@ def init_db():
             "ALTER TABLE sales ADD COLUMN return_collected REAL NOT NULL DEFAULT 0",
             "ALTER TABLE sales ADD COLUMN return_owe REAL NOT NULL DEFAULT 0",
             "ALTER TABLE sales ADD COLUMN return_paid_back REAL NOT NULL DEFAULT 0",
+            "ALTER TABLE raw_items ADD COLUMN available REAL NOT NULL DEFAULT 0",
+            "ALTER TABLE products ADD COLUMN low_stock_threshold REAL NOT NULL DEFAULT 0",
         ]:
             try: db.execute(sql); db.commit()
             except: pass
+        # Partial indexes — only outstanding rows are indexed, so dues/aging stay small
+        db.executescript("""
+            CREATE INDEX IF NOT EXISTS idx_sales_due ON sales(customer_phone, date)
+                WHERE due_amount>0 AND is_return=0;
+            CREATE INDEX IF NOT EXISTS idx_purchases_due ON purchases(supplier_name, date)
+                WHERE due_amount>0;
+            CREATE INDEX IF NOT EXISTS idx_sales_return_due ON sales(return_date)
+                WHERE is_return=1 AND return_owe>return_paid_back;
+            -- Full per-account indexes for ledger statements
+            CREATE INDEX IF NOT EXISTS idx_sales_customer ON sales(customer_phone, date);
+            CREATE INDEX IF NOT EXISTS idx_purchases_supplier ON purchases(supplier_name, date);
+            CREATE INDEX IF NOT EXISTS idx_sale_payments_sale ON sale_payments(sale_id);
+            CREATE INDEX IF NOT EXISTS idx_purchase_payments_purchase ON purchase_payments(purchase_id);
+            CREATE TABLE IF NOT EXISTS return_paybacks (
+                id         INTEGER PRIMARY KEY AUTOINCREMENT,
+                sale_id    INTEGER NOT NULL REFERENCES sales(id),
+                added_by   INTEGER REFERENCES users(id),
+                amount     REAL NOT NULL,
+                date       TEXT NOT NULL,
+                notes      TEXT,
+                created_at TEXT DEFAULT (datetime('now'))
+            );
+            CREATE INDEX IF NOT EXISTS idx_return_paybacks_sale ON return_paybacks(sale_id);
+            CREATE TABLE IF NOT EXISTS changes (
+                version INTEGER PRIMARY KEY AUTOINCREMENT,
+                tbl     TEXT NOT NULL,
+                row_id  INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS sync_ops (
+                client_id  TEXT NOT NULL,
+                op_id      TEXT NOT NULL,
+                status     TEXT NOT NULL,
+                server_id  INTEGER,
+                detail     TEXT,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (client_id, op_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS meta (
+                key   TEXT PRIMARY KEY,
+                value TEXT
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_order_items_sale ON order_items(sale_id);
+            CREATE INDEX IF NOT EXISTS idx_order_items_product ON order_items(product_id);
+            CREATE TABLE IF NOT EXISTS daily_totals (
+                dim    TEXT NOT NULL,
+                day    TEXT NOT NULL,
+                key    TEXT NOT NULL,
+                label  TEXT,
+                amount REAL NOT NULL DEFAULT 0,
+                qty    REAL NOT NULL DEFAULT 0,
+                cnt    INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (dim, day, key)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS stock_alerts (
+                id         INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind       TEXT NOT NULL,
+                ref_id     INTEGER NOT NULL,
+                name       TEXT,
+                level      REAL,
+                threshold  REAL,
+                state      TEXT NOT NULL,
+                created_at TEXT DEFAULT (datetime('now'))
+            );
+            CREATE INDEX IF NOT EXISTS idx_stock_alerts_ref ON stock_alerts(kind, ref_id, id);
+            CREATE TABLE IF NOT EXISTS table_versions (
+                name    TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID;
+        """)
+        # Change counters for the read cache — bumped by triggers so every write path counts
+        for t in CACHED_TABLES:
+            db.execute("INSERT OR IGNORE INTO table_versions(name,version) VALUES(?,0)", (t,))
+            for op in ("INSERT", "UPDATE", "DELETE"):
+                db.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{t}_{op.lower()}_version AFTER {op} ON {t} "
+                           f"BEGIN UPDATE table_versions SET version=version+1 WHERE name='{t}'; END")
+        # Every sale is header + order_items lines. Sales written before that get their line
+        # from the 'migrate_order_lines' job (queued once, in batches) or lazily by sale_lines().
+        if not db.execute("SELECT 1 FROM meta WHERE key='order_lines_migrated'").fetchone() and \
+           not db.execute("SELECT 1 FROM jobs WHERE kind='migrate_order_lines' AND status IN ('queued','running')").fetchone():
+            db.execute("INSERT INTO jobs(kind,priority) VALUES('migrate_order_lines',10)")
+        # Files created before auto_vacuum=INCREMENTAL need one full VACUUM to switch over. It locks
+        # the shop for its whole run, so an admin queues it (POST /api/jobs {"kind":"compact"}) for a
+        # quiet hour; drop any copy that older versions queued automatically at startup.
+        db.execute("DELETE FROM jobs WHERE kind='compact' AND status='queued' AND added_by IS NULL")
+        # Leaderboard aggregates: built once from history, then kept current by triggers
+        # (re)created when their definition changed; the totals are then rebuilt since the old
+        # triggers may have missed writes
+        stale = False
+        for name, sql in daily_triggers():
+            old = db.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name=?", (name,)).fetchone()
+            if old and old[0] == sql: continue
+            if old: db.execute(f"DROP TRIGGER {name}"); stale = True
+            db.execute(sql)
+        if stale or not db.execute("SELECT 1 FROM meta WHERE key='daily_totals_built'").fetchone():
+            rebuild_daily_totals(db)
+        # Paybacks used to be only a running total on the sale: keep each old total as one entry
+        if not db.execute("SELECT 1 FROM meta WHERE key='return_paybacks_built'").fetchone():
+            db.execute("INSERT INTO return_paybacks(sale_id,amount,date,notes) SELECT id, return_paid_back, return_date, "
+                       "'paid back before itemised paybacks' FROM sales s WHERE return_paid_back>0 AND NOT EXISTS "
+                       "(SELECT 1 FROM return_paybacks b WHERE b.sale_id=s.id)")
+            db.execute("INSERT OR REPLACE INTO meta(key,value) VALUES('return_paybacks_built', datetime('now'))")
+        # Stock levels and low-stock crossings, maintained incrementally (see stock_triggers)
+        for sql in stock_triggers(): db.execute(sql)
+        if not db.execute("SELECT 1 FROM meta WHERE key='stock_levels_built'").fetchone():
+            db.execute(f"UPDATE raw_items SET available={RAW_AVAILABLE_SQL.format(name='raw_items.name')}")
+            db.execute("INSERT OR REPLACE INTO meta(key,value) VALUES('stock_levels_built', datetime('now'))")
+        # Row-level change log for offline clients — /api/sync returns rows changed after a version
+        for t in SYNC_TABLES:
+            for op, ref in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+                db.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{t}_{op.lower()}_changes AFTER {op} ON {t} "
+                           f"BEGIN INSERT INTO changes(tbl,row_id) VALUES('{t}', {ref}.id); END")
+        db.commit()
         # Clean up any orphaned product_ingredients left by deleted products
         try:
             db.execute("DELETE FROM product_ingredients WHERE product_id NOT IN (SELECT id FROM products)")
             db.commit()
         except: pass
 
-init_db()
+tenant_pool(MAIN_SHOP)   # open + migrate the default shop at startup
 
 def hash_password(p):
     salt = secrets.token_hex(16)
@@ -196,9 +662,9 @@ def verify_password(p, stored):
         return hmac.compare_digest(hashlib.pbkdf2_hmac('sha256', p.encode(), salt.encode(), 100000).hex(), h)
     except: return False
 
-def create_token(uid, email, name, role, can_edit_delete=0):
+def create_token(uid, email, name, role, can_edit_delete=0, shop=MAIN_SHOP):
     return jwt.encode({"id":uid,"email":email,"name":name,"role":role,
-        "can_edit_delete": can_edit_delete,
+        "can_edit_delete": can_edit_delete, "shop": shop,
         "exp":datetime.utcnow()+timedelta(days=30)}, _EFFECTIVE_SECRET, algorithm="HS256")
 
 def get_current_user(creds: HTTPAuthorizationCredentials = Depends(bearer_scheme)):
@@ -210,28 +676,213 @@ def require_admin(user=Depends(get_current_user)):
     if user.get("role") != "admin": raise HTTPException(403, "Admin access required")
     return user
 
+# ── Idempotency ───────────────────────────────────────────────
+# POSTs that create rows or move money. A retry carrying the same Idempotency-Key
+# replays the stored response instead of running the transaction again.
+IDEMPOTENT_PATHS = re.compile(r"^/api/((orders|sales|purchases)(/\d+/(payments|return-payback))?|customers/payments)$")
+IDEMPOTENCY_WAIT = 30          # seconds a duplicate waits for the in-flight original
+IDEMPOTENCY_LEASE = 30         # a pending key older than this was abandoned (its worker died); a
+                               # retry takes it over. Longer than any admitted write can run.
+_idem_last_purge = [0.0]
+
+def _idem_claim(uid, key, path, body_hash):
+    """Insert a pending row (or take over an abandoned one). Returns None if we own the key, else the existing row."""
+    now = time.time()
+    with get_db() as db:
+        if now - _idem_last_purge[0] > 60:
+            db.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (now - IDEMPOTENCY_TTL,))
+            _idem_last_purge[0] = now
+        cur = db.execute("INSERT OR IGNORE INTO idempotency_keys(user_id,key,path,body_hash,created_at) VALUES(?,?,?,?,?)",
+            (uid, key, path, body_hash, now))
+        db.commit()
+        if cur.rowcount == 1: return None
+        cur = db.execute("UPDATE idempotency_keys SET created_at=? WHERE user_id=? AND key=? AND status IS NULL "
+                         "AND created_at<? AND path=? AND body_hash=?", (now, uid, key, now - IDEMPOTENCY_LEASE, path, body_hash))
+        db.commit()
+        if cur.rowcount == 1: return None
+        return dict(db.execute("SELECT * FROM idempotency_keys WHERE user_id=? AND key=?", (uid, key)).fetchone())
+
+def _idem_finish(uid, key, status, body):
+    with get_db() as db:
+        if status >= 500:   # let the client retry a server error for real
+            db.execute("DELETE FROM idempotency_keys WHERE user_id=? AND key=?", (uid, key))
+        else:
+            db.execute("UPDATE idempotency_keys SET status=?, response=? WHERE user_id=? AND key=?", (status, body, uid, key))
+        db.commit()
+
+def _idem_replay(row):
+    return Response(content=row["response"], status_code=row["status"], media_type="application/json",
+                    headers={"Idempotent-Replayed": "true"})
+
+@app.middleware("http")
+async def idempotency_middleware(request: Request, call_next):
+    key = request.headers.get("idempotency-key")
+    if request.method != "POST" or not key or not IDEMPOTENT_PATHS.match(request.url.path):
+        return await call_next(request)
+    try:
+        token = request.headers.get("authorization", "").split(" ", 1)[1]
+        uid = jwt.decode(token, _EFFECTIVE_SECRET, algorithms=["HS256"])["id"]
+    except Exception:
+        return await call_next(request)   # the route's own auth check will reject it
+    if len(key) > 255: return JSONResponse({"detail": "Idempotency-Key too long"}, 400)
+    body_hash = hashlib.sha256(await request.body()).hexdigest()
+    deadline = time.time() + IDEMPOTENCY_WAIT
+    while True:
+        row = await run_in_threadpool(_idem_claim, uid, key, request.url.path, body_hash)
+        if row is None: break
+        if row["path"] != request.url.path or row["body_hash"] != body_hash:
+            return JSONResponse({"detail": "Idempotency-Key reused with a different request"}, 422)
+        if row["status"] is not None: return _idem_replay(row)
+        # Original still in flight (in this worker or another) — wait for its stored result
+        if time.time() >= deadline:
+            return JSONResponse({"detail": "A request with this Idempotency-Key is still in progress"}, 409,
+                                headers={"Retry-After": "1"})
+        await asyncio.sleep(0.05)
+    status = 500
+    try:
+        response = await call_next(request)
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        status = response.status_code
+        return Response(content=body, status_code=status, headers=dict(response.headers), media_type=response.media_type)
+    finally:
+        await run_in_threadpool(_idem_finish, uid, key, status, body if status < 500 else None)
+
+@app.middleware("http")
+async def tenant_middleware(request: Request, call_next):
+    """Point get_db() at the shop named in the caller's JWT (default shop when anonymous)."""
+    shop = MAIN_SHOP
+    auth = request.headers.get("authorization", "")
+    if auth[:7].lower() == "bearer ":
+        try: shop = jwt.decode(auth[7:], _EFFECTIVE_SECRET, algorithms=["HS256"]).get("shop") or MAIN_SHOP
+        except Exception: pass   # get_current_user rejects the bad token
+    if shop not in SHOPS: return JSONResponse({"detail": f"Unknown shop '{shop}'"}, 403)
+    current_shop.set(shop)
+    return await call_next(request)
+
+# ── Admission control ─────────────────────────────────────────
+# Each worker admits at most `limit` concurrent requests per class; up to `queue` more wait
+# (FIFO) for at most `wait` seconds, anything beyond that is turned away at once with
+# Retry-After. Till writes get a wide budget and long waits, heavy reports a narrow one, so
+# a burst of analytics can never hold the threadpool or the write lock away from orders.
+# Admitted requests get a deadline that SQLite enforces through get_db's progress handler.
+ADMISSION = {   # class -> limit, queue, wait (s), deadline (s), status when overflowing
+    "write":       dict(limit=int(os.getenv("ADMIT_WRITE", "32")),       queue=256, wait=10,  deadline=20, status=503),
+    "interactive": dict(limit=int(os.getenv("ADMIT_INTERACTIVE", "16")), queue=64,  wait=3,   deadline=10, status=503),
+    "heavy":       dict(limit=int(os.getenv("ADMIT_HEAVY", "4")),        queue=16,  wait=5,   deadline=30, status=429),
+}
+WRITE_PATHS    = re.compile(r"^/api/((orders|sales|purchases)(/\d+/(payments|return|return-payback))?|customers/payments|sync)$")
+# Only full-history scans are heavy: dues, aging, inventory, summary and leaderboards are
+# indexed or aggregate reads that staff screens (and the Dashboard) fetch in parallel.
+HEAVY_PATHS    = re.compile(r"^/(api/analytics/(monthly|products)$|api/admin/storage$|api/jobs/\d+/download$|admin/(query|shops/report)$)")
+ROUTE_DEADLINES = {"/admin/query": 5}   # per-route overrides of the class deadline
+
+def admission_class(method, path):
+    if method == "POST" and WRITE_PATHS.match(path): return "write"
+    if HEAVY_PATHS.match(path): return "heavy"
+    if path.startswith(("/api/", "/admin")) and not path.startswith(("/api/images/", "/api/alerts/stream")): return "interactive"
+    return None   # health, docs, public images, long-lived event streams
+
+class AdmissionGate:
+    """Concurrency limit with a bounded FIFO queue. Freed slots are handed straight to the
+    oldest waiter (a future on its own loop), so the gate works across event loops."""
+    def __init__(self, name, limit, queue, wait, deadline, status):
+        self.name, self.limit, self.queue, self.wait, self.deadline, self.status = name, limit, queue, wait, deadline, status
+        self.lock, self.active, self.waiters = threading.Lock(), 0, deque()
+        self.counts  = {"admitted": 0, "rejected": 0, "timed_out": 0, "deadline_exceeded": 0}
+        self.samples = deque(maxlen=1000)   # recent queue times (ms)
+
+    async def acquire(self):
+        t0 = time.monotonic()
+        with self.lock:
+            if self.active < self.limit and not self.waiters:
+                self.active += 1; self._admitted(t0); return True
+            if len(self.waiters) >= self.queue:
+                self.counts["rejected"] += 1; return False
+            fut = asyncio.get_running_loop().create_future()
+            self.waiters.append(fut)
+        try: await asyncio.wait_for(fut, self.wait)
+        except asyncio.TimeoutError:
+            with self.lock:
+                if fut in self.waiters: self.waiters.remove(fut)
+                self.counts["timed_out"] += 1
+            if fut.done() and not fut.cancelled(): self.release()   # granted just as we gave up
+            return False   # (a grant still in flight is passed on by _grant)
+        with self.lock: self._admitted(t0)
+        return True
+
+    def _admitted(self, t0):
+        self.counts["admitted"] += 1
+        self.samples.append((time.monotonic() - t0) * 1000)
+
+    def release(self):
+        with self.lock:
+            if not self.waiters:
+                self.active -= 1; return
+            fut = self.waiters.popleft()
+        fut.get_loop().call_soon_threadsafe(self._grant, fut)
+
+    def _grant(self, fut):
+        if fut.done(): self.release()   # waiter gave up meanwhile — pass the slot on
+        else: fut.set_result(True)
+
+    def stats(self):
+        with self.lock:
+            q = sorted(self.samples)
+            pct = lambda p: round(q[min(len(q)-1, int(p*len(q)))], 2) if q else None
+            return {"limit": self.limit, "active": self.active, "queued": len(self.waiters), "max_queue": self.queue,
+                    "deadline_sec": self.deadline, **self.counts,
+                    "queue_ms": {"avg": round(sum(q)/len(q), 2) if q else None, "p50": pct(0.5), "p95": pct(0.95),
+                                 "max": round(q[-1], 2) if q else None}}
+
+admission_gates = {name: AdmissionGate(name, **cfg) for name, cfg in ADMISSION.items()}
+
+@app.middleware("http")
+async def admission_middleware(request: Request, call_next):
+    cls = admission_class(request.method, request.url.path)
+    if cls is None: return await call_next(request)
+    gate = admission_gates[cls]
+    if not await gate.acquire():
+        retry = 1 if cls == "write" else 5
+        return JSONResponse({"detail": f"Server busy ({cls} requests), retry shortly"}, gate.status,
+                            headers={"Retry-After": str(retry)})
+    try:
+        request_deadline.set((time.monotonic() + ROUTE_DEADLINES.get(request.url.path, gate.deadline), gate))
+        return await call_next(request)
+    finally:
+        gate.release()
+
+# Registered after the other middleware so it is the outermost layer and
+# replayed / rejected responses still carry CORS headers.
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+
 # ── Models ────────────────────────────────────────────────────
-class RegisterReq(BaseModel): name:str; email:str; password:str
-class LoginReq(BaseModel): email:str; password:str
+class RegisterReq(BaseModel): name:str; email:str; password:str; shop:str=MAIN_SHOP; admin_password:Optional[str]=None
+class LoginReq(BaseModel): email:str; password:str; shop:str=MAIN_SHOP
 class CreateUserReq(BaseModel): name:str; email:str; password:str; role:str="staff"; can_edit_delete:int=0
 class ResetPasswordReq(BaseModel): new_password:str
 class SupplierCreate(BaseModel): name:str; phone:Optional[str]=None; address:Optional[str]=None; notes:Optional[str]=None
 class PurchaseCreate(BaseModel): date:str; supplier_name:str; item:str; qty:float; unit:str="units"; unit_cost:float; paid_amount:float=0; low_stock_alert:float=0; notes:Optional[str]=None
 class PurchasePaymentCreate(BaseModel): amount:float; date:str; notes:Optional[str]=None
-class ProductCreate(BaseModel): name:str; description:Optional[str]=None; defined_price:float; unit:str="pcs"; qty_available:float=0; is_active:int=1
+class ProductCreate(BaseModel): name:str; description:Optional[str]=None; defined_price:float; unit:str="pcs"; qty_available:float=0; is_active:int=1; low_stock_threshold:Optional[float]=None
 class CustomerCreate(BaseModel): name:str; phone:Optional[str]=None; address:Optional[str]=None
 class SaleCreate(BaseModel): date:str; customer_name:str; customer_phone:Optional[str]=None; customer_addr:Optional[str]=None; product_id:Optional[int]=None; product_name:str; qty:float; unit:str="pcs"; defined_price:float=0; unit_price:float; paid_amount:float=0; payment_notes:Optional[str]=None; notes:Optional[str]=None
 class SalePaymentCreate(BaseModel): amount:float; date:str; notes:Optional[str]=None
+class CustomerPaymentCreate(BaseModel): customer_phone:str; amount:float; date:str; notes:Optional[str]=None; sale_ids:Optional[list[int]]=None
 class SaleReturnCreate(BaseModel): date:str; notes:Optional[str]=None; return_collected:float=0; return_owe:float=0
-class QueryRequest(BaseModel): sql:str; password:str
+class QueryRequest(BaseModel): sql:str; password:str; shop:str=MAIN_SHOP
+class ShopsReportReq(BaseModel): password:str
 # Product builder models
 class IngredientItem(BaseModel): item_name:str; qty:float; unit:str="units"; unit_cost:float=0
 class ChargeItem(BaseModel): label:str; amount:float
 class ProductBuildCreate(BaseModel):
-    name:str; description:Optional[str]=None; unit:str="pcs"; qty_available:float=0; is_active:int=1
+    name:str; description:Optional[str]=None; unit:str="pcs"; qty_available:float=0; is_active:int=1; low_stock_threshold:float=0
     ingredients:Optional[list]=[]
     charges:Optional[list]=[]
+class StockThresholdUpdate(BaseModel): low_stock_threshold:float
 # Multi-product order models
+class JobCreate(BaseModel): kind:str; params:Optional[dict]=None; priority:int=0
+class SyncOp(BaseModel): op_id:str; type:str; data:dict; ref:Optional[str]=None
+class SyncRequest(BaseModel): client_id:str; since:int=0; ops:list[SyncOp]=[]
 class OrderLineItem(BaseModel): product_id:Optional[int]=None; product_name:str; qty:float; unit:str="pcs"; unit_price:float
 class OrderCreate(BaseModel):
     date:str; customer_name:str; customer_phone:Optional[str]=None; customer_addr:Optional[str]=None
@@ -244,16 +895,20 @@ def register(data: RegisterReq):
         if not data.email or "@" not in data.email or "." not in data.email.split("@")[-1]:
             raise HTTPException(400, "Please enter a valid email address")
         if len(data.password) < 6: raise HTTPException(400, "Password must be at least 6 characters")
+        shop = check_shop(data.shop); current_shop.set(shop)
         with get_db() as db:
             count = db.execute("SELECT COUNT(*) as c FROM users").fetchone()["c"]
             role  = "admin" if count == 0 else "staff"
+            # Branches are configured up front, so an empty one must not go to whoever registers first
+            if count == 0 and shop != MAIN_SHOP and data.admin_password != ADMIN_PASSWORD:
+                raise HTTPException(403, "The first account of a branch needs the admin password")
             if db.execute("SELECT id FROM users WHERE email=?", (data.email,)).fetchone():
                 raise HTTPException(409, "Email already registered")
             cur = db.execute("INSERT INTO users(name,email,password,role) VALUES(?,?,?,?)",
                 (data.name, data.email, hash_password(data.password), role))
             db.commit()
-            return {"token": create_token(cur.lastrowid, data.email, data.name, role, 0),
-                    "user": {"id":cur.lastrowid,"name":data.name,"email":data.email,"role":role,"can_edit_delete":0}}
+            return {"token": create_token(cur.lastrowid, data.email, data.name, role, 0, shop),
+                    "user": {"id":cur.lastrowid,"name":data.name,"email":data.email,"role":role,"can_edit_delete":0,"shop":shop}}
     except HTTPException:
         raise
     except Exception as e:
@@ -262,14 +917,15 @@ def register(data: RegisterReq):
 @app.post("/api/auth/login")
 def login(data: LoginReq):
     try:
+      shop = check_shop(data.shop); current_shop.set(shop)
       with get_db() as db:
         u = db.execute("SELECT * FROM users WHERE email=?", (data.email,)).fetchone()
         if not u or not verify_password(data.password, u["password"]):
             raise HTTPException(401, "Invalid email or password")
         if not u["is_active"]: raise HTTPException(403, "Account disabled")
         ced = u["can_edit_delete"] if "can_edit_delete" in u.keys() else 0
-        return {"token": create_token(u["id"],u["email"],u["name"],u["role"],ced),
-                "user": {"id":u["id"],"name":u["name"],"email":u["email"],"role":u["role"],"can_edit_delete":ced}}
+        return {"token": create_token(u["id"],u["email"],u["name"],u["role"],ced,shop),
+                "user": {"id":u["id"],"name":u["name"],"email":u["email"],"role":u["role"],"can_edit_delete":ced,"shop":shop}}
     except HTTPException:
         raise
     except Exception as e:
@@ -282,7 +938,10 @@ def get_me(user=Depends(get_current_user)):
 
 # ── Users ─────────────────────────────────────────────────────
 @app.get("/api/users")
-def list_users(admin=Depends(require_admin)):
+def list_users(request:Request, admin=Depends(require_admin)):
+    return response_cache.get(cache_key(request, admin), ("users",), _list_users)
+
+def _list_users():
     with get_db() as db:
         return [dict(r) for r in db.execute("SELECT id,name,email,role,is_active,can_edit_delete,created_at FROM users ORDER BY created_at").fetchall()]
 
@@ -327,7 +986,10 @@ def toggle_user(uid:int, admin=Depends(require_admin)):
 
 # ── Suppliers (shared) ────────────────────────────────────────
 @app.get("/api/suppliers")
-def list_suppliers(user=Depends(get_current_user)):
+def list_suppliers(request:Request, user=Depends(get_current_user)):
+    return response_cache.get(cache_key(request, user), ("suppliers",), _list_suppliers)
+
+def _list_suppliers():
     with get_db() as db:
         return [dict(r) for r in db.execute("SELECT * FROM suppliers ORDER BY name").fetchall()]
 
@@ -344,6 +1006,87 @@ def delete_supplier(sid:int, admin=Depends(require_admin)):
     with get_db() as db:
         db.execute("DELETE FROM suppliers WHERE id=?", (sid,)); db.commit(); return {"success":True}
 
+# ── Images ────────────────────────────────────────────────────
+# Uploads are streamed to MEDIA_DIR/<shop>/<token>/ and a small worker pool writes
+# metadata-free WebP renditions next to them. image_data on products/purchases holds
+# the /api/images URL; older rows may still hold a base64 data: URL.
+MEDIA_DIR     = os.getenv("MEDIA_DIR", os.path.join(TENANT_DIR, "media"))
+IMAGE_SIZES   = {"thumb": 96, "small": 320, "medium": 960}   # longest edge in px
+IMAGE_MIMES   = {"jpg":"image/jpeg","jpeg":"image/jpeg","png":"image/png","webp":"image/webp"}
+MAX_IMAGE     = 5*1024*1024
+UPLOAD_CHUNK  = 256*1024
+TOKEN_RE      = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+_image_workers = ThreadPoolExecutor(max_workers=int(os.getenv("IMAGE_WORKERS", "2")), thread_name_prefix="images")
+
+def _image_dir(shop, token): return os.path.join(MEDIA_DIR, shop, token)
+
+def save_image(file, owner, owner_id):
+    """Stream an upload to disk, replace the owner's previous image and queue its renditions."""
+    ext = (file.filename or "").split(".")[-1].lower()
+    if ext not in IMAGE_MIMES: ext = "jpg"
+    shop, token = current_shop.get(), secrets.token_urlsafe(16)
+    folder = _image_dir(shop, token)
+    os.makedirs(folder)
+    path, size = os.path.join(folder, f"orig.{ext}"), 0
+    try:
+        with open(path, "wb") as out:
+            for chunk in iter(lambda: file.file.read(UPLOAD_CHUNK), b""):
+                size += len(chunk)
+                if size > MAX_IMAGE: raise HTTPException(400,"Image too large (max 5MB)")
+                out.write(chunk)
+    except BaseException:
+        shutil.rmtree(folder, ignore_errors=True); raise
+    with get_db() as db:
+        drop_images(db, owner, owner_id)
+        db.execute("INSERT INTO images(token,owner,owner_id,file_name,mime,bytes) VALUES(?,?,?,?,?,?)",
+            (token, owner, owner_id, file.filename, IMAGE_MIMES[ext], size))
+        db.commit()
+    _image_workers.submit(make_renditions, shop, token, path)
+    return f"/api/images/{shop}/{token}"
+
+def drop_images(db, owner, owner_id):
+    """Delete an owner's image rows and files (caller commits)."""
+    shop = current_shop.get()
+    for r in db.execute("SELECT token FROM images WHERE owner=? AND owner_id=?", (owner, owner_id)).fetchall():
+        shutil.rmtree(_image_dir(shop, r["token"]), ignore_errors=True)
+    db.execute("DELETE FROM images WHERE owner=? AND owner_id=?", (owner, owner_id))
+
+def make_renditions(shop, token, path):
+    """Worker: write <size>.webp for each IMAGE_SIZES entry and record the original's dimensions."""
+    try:
+        with Image.open(path) as im:
+            im = ImageOps.exif_transpose(im)   # bake in camera rotation before EXIF is dropped
+            width, height = im.size
+            if im.mode not in ("RGB", "RGBA"): im = im.convert("RGBA" if "transparency" in im.info else "RGB")
+            for name, edge in IMAGE_SIZES.items():
+                out = im.copy()
+                out.thumbnail((edge, edge), Image.LANCZOS)
+                tmp = os.path.join(os.path.dirname(path), f"{name}.webp.part")
+                out.save(tmp, "WEBP", quality=80, method=4)
+                os.replace(tmp, tmp[:-5])
+        with get_db(shop) as db:
+            db.execute("UPDATE images SET status='ready', width=?, height=? WHERE token=?", (width, height, token))
+    except Exception as e:
+        with get_db(shop) as db:
+            db.execute("UPDATE images SET status='failed', error=? WHERE token=?", (str(e), token))
+
+@app.get("/api/images/{shop}/{token}")
+def get_image(shop:str, token:str, size:str="small"):
+    """Serve a rendition (thumb/small/medium) or the original (size=orig). Public: the token is the
+    capability, so plain <img> tags work. Falls back to the original until renditions exist."""
+    shop = check_shop(shop)
+    if not TOKEN_RE.match(token): raise HTTPException(404, "Not found")
+    folder = _image_dir(shop, token)
+    cache = {"Cache-Control": "public, max-age=31536000, immutable"}
+    if size in IMAGE_SIZES and os.path.exists(os.path.join(folder, f"{size}.webp")):
+        return FileResponse(os.path.join(folder, f"{size}.webp"), media_type="image/webp", headers=cache)
+    if size != "orig" and size not in IMAGE_SIZES: raise HTTPException(400, f"size must be one of: orig, {', '.join(IMAGE_SIZES)}")
+    origs = [n for n in os.listdir(folder) if n.startswith("orig.")] if os.path.isdir(folder) else []
+    if not origs: raise HTTPException(404, "Not found")
+    ext = origs[0].split(".")[-1]
+    return FileResponse(os.path.join(folder, origs[0]), media_type=IMAGE_MIMES.get(ext, "image/jpeg"),
+                        headers=cache if size == "orig" else {"Cache-Control": "no-cache"})
+
 # ── Purchases (shared) ────────────────────────────────────────
 @app.get("/api/purchases")
 def list_purchases(user=Depends(get_current_user)):
@@ -353,62 +1096,69 @@ def list_purchases(user=Depends(get_current_user)):
 @app.post("/api/purchases", status_code=201)
 def create_purchase(data:PurchaseCreate, user=Depends(get_current_user)):
     try:
-        total = data.qty * data.unit_cost
-        paid  = min(data.paid_amount, total)
-        due   = total - paid
-        status = "paid" if paid>=total else ("partial" if paid>0 else "unpaid")
         with get_db() as db:
-            if not db.execute("SELECT id FROM raw_items WHERE name=?", (data.item,)).fetchone():
-                db.execute("INSERT INTO raw_items(name,unit,low_stock_threshold) VALUES(?,?,?)",
-                    (data.item, data.unit or "units", data.low_stock_alert or 0))
-            else:
-                db.execute("UPDATE raw_items SET low_stock_threshold=? WHERE name=?",
-                    (data.low_stock_alert or 0, data.item))
-            cur = db.execute(
-                "INSERT INTO purchases(added_by,date,supplier_name,item,qty,unit,unit_cost,total,"
-                "paid_amount,due_amount,payment_status,low_stock_alert,notes) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)",
-                (user["id"],data.date,data.supplier_name,data.item,data.qty,
-                 data.unit or "units",data.unit_cost,
-                 total,paid,due,status,data.low_stock_alert or 0,data.notes))
-            if paid>0:
-                db.execute(
-                    "INSERT INTO purchase_payments(purchase_id,added_by,amount,date,notes) VALUES(?,?,?,?,?)",
-                    (cur.lastrowid,user["id"],paid,data.date,"Initial payment"))
+            pid = insert_purchase(db, data, user)
             db.commit()
-            return dict(db.execute("SELECT * FROM purchases WHERE id=?", (cur.lastrowid,)).fetchone())
+            return dict(db.execute("SELECT * FROM purchases WHERE id=?", (pid,)).fetchone())
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(500, f"Failed to save purchase: {str(e)}")
 
+def insert_purchase(db, data, user):
+    """Raw-item upsert + purchase row + initial payment. Caller commits; returns the purchase id."""
+    total = data.qty * data.unit_cost
+    paid  = min(data.paid_amount, total)
+    due   = total - paid
+    status = "paid" if paid>=total else ("partial" if paid>0 else "unpaid")
+    if not db.execute("SELECT id FROM raw_items WHERE name=?", (data.item,)).fetchone():
+        db.execute("INSERT INTO raw_items(name,unit,low_stock_threshold) VALUES(?,?,?)",
+            (data.item, data.unit or "units", data.low_stock_alert or 0))
+    else:
+        db.execute("UPDATE raw_items SET low_stock_threshold=? WHERE name=?",
+            (data.low_stock_alert or 0, data.item))
+    cur = db.execute(
+        "INSERT INTO purchases(added_by,date,supplier_name,item,qty,unit,unit_cost,total,"
+        "paid_amount,due_amount,payment_status,low_stock_alert,notes) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)",
+        (user["id"],data.date,data.supplier_name,data.item,data.qty,
+         data.unit or "units",data.unit_cost,
+         total,paid,due,status,data.low_stock_alert or 0,data.notes))
+    if paid>0:
+        db.execute(
+            "INSERT INTO purchase_payments(purchase_id,added_by,amount,date,notes) VALUES(?,?,?,?,?)",
+            (cur.lastrowid,user["id"],paid,data.date,"Initial payment"))
+    return cur.lastrowid
+
 @app.post("/api/purchases/{pid}/image")
-async def upload_purchase_image(pid:int, file:UploadFile=File(...), user=Depends(get_current_user)):
-    contents = await file.read()
-    if len(contents)>5*1024*1024: raise HTTPException(400,"Image too large (max 5MB)")
-    ext  = file.filename.split(".")[-1].lower()
-    mime = {"jpg":"image/jpeg","jpeg":"image/jpeg","png":"image/png","webp":"image/webp"}.get(ext,"image/jpeg")
-    data_url = f"data:{mime};base64,{base64.b64encode(contents).decode()}"
-    with get_db() as db:
-        db.execute("UPDATE purchases SET image_data=?,image_name=? WHERE id=?", (data_url,file.filename,pid))
+def upload_purchase_image(pid:int, file:UploadFile=File(...), user=Depends(get_current_user)):
+    with get_db() as db:
+        if not db.execute("SELECT id FROM purchases WHERE id=?", (pid,)).fetchone(): raise HTTPException(404,"Not found")
+    url = save_image(file, "purchase", pid)
+    with get_db() as db:
+        db.execute("UPDATE purchases SET image_data=?,image_name=? WHERE id=?", (url,file.filename,pid))
         db.commit()
-    return {"success":True,"image_data":data_url}
+    return {"success":True,"image_data":url}
 
 @app.post("/api/purchases/{pid}/payments", status_code=201)
 def add_purchase_payment(pid:int, data:PurchasePaymentCreate, user=Depends(get_current_user)):
     with get_db() as db:
-        p = db.execute("SELECT * FROM purchases WHERE id=?", (pid,)).fetchone()
-        if not p: raise HTTPException(404,"Not found")
-        if p["due_amount"]<=0: raise HTTPException(400,"Already fully paid")
-        payment  = min(data.amount, p["due_amount"])
-        new_paid = p["paid_amount"]+payment
-        new_due  = p["total"]-new_paid
-        db.execute("UPDATE purchases SET paid_amount=?,due_amount=?,payment_status=? WHERE id=?",
-            (new_paid, max(0,new_due), "paid" if new_due<=0 else "partial", pid))
-        db.execute("INSERT INTO purchase_payments(purchase_id,added_by,amount,date,notes) VALUES(?,?,?,?,?)",
-            (pid,user["id"],payment,data.date,data.notes))
+        apply_purchase_payment(db, pid, data, user)
         db.commit()
         return dict(db.execute("SELECT * FROM purchases WHERE id=?", (pid,)).fetchone())
 
+def apply_purchase_payment(db, pid, data, user):
+    """Pay down one purchase. Caller commits."""
+    p = db.execute("SELECT * FROM purchases WHERE id=?", (pid,)).fetchone()
+    if not p: raise HTTPException(404,"Not found")
+    if p["due_amount"]<=0: raise HTTPException(400,"Already fully paid")
+    payment  = min(data.amount, p["due_amount"])
+    new_paid = p["paid_amount"]+payment
+    new_due  = p["total"]-new_paid
+    db.execute("UPDATE purchases SET paid_amount=?,due_amount=?,payment_status=? WHERE id=?",
+        (new_paid, max(0,new_due), "paid" if new_due<=0 else "partial", pid))
+    db.execute("INSERT INTO purchase_payments(purchase_id,added_by,amount,date,notes) VALUES(?,?,?,?,?)",
+        (pid,user["id"],payment,data.date,data.notes))
+
 @app.get("/api/purchases/{pid}/payments")
 def get_purchase_payments(pid:int, user=Depends(get_current_user)):
     with get_db() as db:
@@ -445,6 +1195,7 @@ def delete_purchase(pid:int, user=Depends(get_current_user)):
             )
             # Delete purchase_payments first (no ON DELETE CASCADE on this FK)
             db.execute("DELETE FROM purchase_payments WHERE purchase_id=?", (pid,))
+            drop_images(db, "purchase", pid)
             db.execute("DELETE FROM purchases WHERE id=?", (pid,))
             # Clean up raw_items entry if no more purchases exist for this item
             remaining = db.execute(
@@ -461,7 +1212,10 @@ def delete_purchase(pid:int, user=Depends(get_current_user)):
 
 # ── Products (shared, with qty) ───────────────────────────────
 @app.get("/api/products")
-def list_products(user=Depends(get_current_user)):
+def list_products(request:Request, user=Depends(get_current_user)):
+    return response_cache.get(cache_key(request, user), ("products",), _list_products)
+
+def _list_products():
     with get_db() as db:
         return [dict(r) for r in db.execute("SELECT * FROM products ORDER BY name").fetchall()]
 
@@ -470,8 +1224,8 @@ def create_product(data:ProductCreate, user=Depends(get_current_user)):
     try:
         with get_db() as db:
             cur = db.execute(
-                "INSERT INTO products(name,description,defined_price,unit,qty_available,is_active) VALUES(?,?,?,?,?,?)",
-                (data.name,data.description,data.defined_price,data.unit or "pcs",data.qty_available or 0,data.is_active))
+                "INSERT INTO products(name,description,defined_price,unit,qty_available,is_active,low_stock_threshold) VALUES(?,?,?,?,?,?,?)",
+                (data.name,data.description,data.defined_price,data.unit or "pcs",data.qty_available or 0,data.is_active,data.low_stock_threshold or 0))
             db.commit()
             return dict(db.execute("SELECT * FROM products WHERE id=?", (cur.lastrowid,)).fetchone())
     except HTTPException:
@@ -484,20 +1238,21 @@ def update_product(pid:int, data:ProductCreate, user=Depends(get_current_user)):
     with get_db() as db:
         if not db.execute("SELECT id FROM products WHERE id=?", (pid,)).fetchone():
             raise HTTPException(404,"Not found")
-        db.execute("UPDATE products SET name=?,description=?,defined_price=?,unit=?,qty_available=?,is_active=? WHERE id=?",
-            (data.name,data.description,data.defined_price,data.unit,data.qty_available,data.is_active,pid))
+        db.execute("UPDATE products SET name=?,description=?,defined_price=?,unit=?,qty_available=?,is_active=?,"
+                   "low_stock_threshold=COALESCE(?,low_stock_threshold) WHERE id=?",
+            (data.name,data.description,data.defined_price,data.unit,data.qty_available,data.is_active,data.low_stock_threshold,pid))
         db.commit()
         return dict(db.execute("SELECT * FROM products WHERE id=?", (pid,)).fetchone())
-async def upload_product_image(pid:int, file:UploadFile=File(...), admin=Depends(require_admin)):
-    contents = await file.read()
-    if len(contents)>5*1024*1024: raise HTTPException(400,"Image too large (max 5MB)")
-    ext  = file.filename.split(".")[-1].lower()
-    mime = {"jpg":"image/jpeg","jpeg":"image/jpeg","png":"image/png","webp":"image/webp"}.get(ext,"image/jpeg")
-    data_url = f"data:{mime};base64,{base64.b64encode(contents).decode()}"
-    with get_db() as db:
-        db.execute("UPDATE products SET image_data=?,image_name=? WHERE id=?", (data_url,file.filename,pid))
+
+@app.post("/api/products/{pid}/image")
+def upload_product_image(pid:int, file:UploadFile=File(...), admin=Depends(require_admin)):
+    with get_db() as db:
+        if not db.execute("SELECT id FROM products WHERE id=?", (pid,)).fetchone(): raise HTTPException(404,"Not found")
+    url = save_image(file, "product", pid)
+    with get_db() as db:
+        db.execute("UPDATE products SET image_data=?,image_name=? WHERE id=?", (url,file.filename,pid))
         db.commit()
-    return {"success":True,"image_data":data_url}
+    return {"success":True,"image_data":url}
 
 @app.delete("/api/products/{pid}")
 def delete_product(pid:int, admin=Depends(require_admin)):
@@ -506,19 +1261,22 @@ def delete_product(pid:int, admin=Depends(require_admin)):
             prod = db.execute("SELECT * FROM products WHERE id=?", (pid,)).fetchone()
             if not prod: raise HTTPException(404, "Product not found")
             # Block if product has been ordered
-            in_sales = db.execute(
-                "SELECT COUNT(*) as cnt FROM sales WHERE product_id=? AND is_return=0", (pid,)
-            ).fetchone()
-            in_orders = db.execute(
-                "SELECT COUNT(*) as cnt FROM order_items WHERE product_id=?", (pid,)
-            ).fetchone()
-            total_orders = (in_sales["cnt"] if in_sales else 0) + (in_orders["cnt"] if in_orders else 0)
+            total_orders = db.execute(
+                "SELECT (SELECT COUNT(DISTINCT oi.sale_id) FROM order_items oi JOIN sales s ON s.id=oi.sale_id "
+                "WHERE oi.product_id=? AND s.is_return=0) + "
+                "(SELECT COUNT(*) FROM sales s WHERE product_id=? AND is_return=0 AND NOT EXISTS "
+                "(SELECT 1 FROM order_items oi WHERE oi.sale_id=s.id))", (pid, pid)
+            ).fetchone()[0]  # returned sales don't count; second term: legacy sales the migration job hasn't reached yet
             if total_orders > 0:
                 raise HTTPException(400,
                     f"Cannot delete '{prod['name']}': used in {total_orders} order(s). "
                     f"Mark it as Inactive instead.")
             db.execute("DELETE FROM product_ingredients WHERE product_id=?", (pid,))
             db.execute("DELETE FROM product_charges WHERE product_id=?", (pid,))
+            # only returned sales still point here; they keep the product's name
+            db.execute("UPDATE order_items SET product_id=NULL WHERE product_id=?", (pid,))
+            db.execute("UPDATE sales SET product_id=NULL WHERE product_id=?", (pid,))
+            drop_images(db, "product", pid)
             db.execute("DELETE FROM products WHERE id=?", (pid,))
             db.commit()
             return {"success": True}
@@ -566,8 +1324,8 @@ def build_product(data:ProductBuildCreate, user=Depends(get_current_user)):
         defined_price = ingredients_cost + charges_total
         with get_db() as db:
             cur = db.execute(
-                "INSERT INTO products(name,description,defined_price,unit,qty_available,is_active) VALUES(?,?,?,?,?,?)",
-                (data.name, data.description, defined_price, data.unit or "pcs", data.qty_available or 0, data.is_active))
+                "INSERT INTO products(name,description,defined_price,unit,qty_available,is_active,low_stock_threshold) VALUES(?,?,?,?,?,?,?)",
+                (data.name, data.description, defined_price, data.unit or "pcs", data.qty_available or 0, data.is_active, data.low_stock_threshold or 0))
             pid = cur.lastrowid
             for ing in ingredients:
                 db.execute(
@@ -621,65 +1379,113 @@ def create_customer(data:CustomerCreate, user=Depends(get_current_user)):
 def list_sales(user=Depends(get_current_user)):
     with get_db() as db:
         sales = [dict(r) for r in db.execute("SELECT * FROM sales ORDER BY date DESC").fetchall()]
-        # Attach order_items to each sale for multi-product display
-        for s in sales:
-            items = db.execute("SELECT * FROM order_items WHERE sale_id=? ORDER BY id", (s["id"],)).fetchall()
-            s["order_items"] = [dict(i) for i in items]
+        # Attach order_items (the sale's lines) in one pass instead of a query per sale
+        by_sale = {s["id"]: s for s in sales}
+        for s in sales: s["order_items"] = []
+        for i in db.execute("SELECT * FROM order_items ORDER BY id").fetchall():
+            if i["sale_id"] in by_sale: by_sale[i["sale_id"]]["order_items"].append(dict(i))
         return sales
 
 @app.post("/api/sales", status_code=201)
 def create_sale(data:SaleCreate, user=Depends(get_current_user)):
     try:
-        total = data.qty * data.unit_price
-        paid  = min(data.paid_amount, total)
-        due   = total - paid
-        status = "paid" if paid>=total else ("partial" if paid>0 else "unpaid")
         with get_db() as db:
-            if data.product_id:
-                prod = db.execute("SELECT * FROM products WHERE id=?", (data.product_id,)).fetchone()
-                if prod and prod["qty_available"] < data.qty:
-                    raise HTTPException(400, f"Not enough stock. Available: {prod['qty_available']}")
-                if prod:
-                    db.execute("UPDATE products SET qty_available=qty_available-? WHERE id=?",
-                               (data.qty, data.product_id))
-            if data.customer_phone:
-                if not db.execute("SELECT id FROM customers WHERE phone=?", (data.customer_phone,)).fetchone():
-                    db.execute("INSERT INTO customers(name,phone,address) VALUES(?,?,?)",
-                        (data.customer_name,data.customer_phone,data.customer_addr))
-            cur = db.execute(
-                "INSERT INTO sales(added_by,date,customer_name,customer_phone,customer_addr,"
-                "product_id,product_name,qty,unit,defined_price,unit_price,total,paid_amount,due_amount,payment_status,notes)"
-                " VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
-                (user["id"],data.date,data.customer_name,data.customer_phone,data.customer_addr,
-                 data.product_id,data.product_name,data.qty,data.unit or "pcs",data.defined_price,
-                 data.unit_price,total,paid,due,status,data.notes))
-            if paid>0:
-                db.execute(
-                    "INSERT INTO sale_payments(sale_id,added_by,amount,date,notes) VALUES(?,?,?,?,?)",
-                    (cur.lastrowid,user["id"],paid,data.date, data.payment_notes or "Initial payment"))
+            sid = insert_sale(db, data, user)
             db.commit()
-            return dict(db.execute("SELECT * FROM sales WHERE id=?", (cur.lastrowid,)).fetchone())
+            return dict(db.execute("SELECT * FROM sales WHERE id=?", (sid,)).fetchone())
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(500, f"Failed to save order: {str(e)}")
 
+def insert_sale(db, data, user):
+    """Single-product sale: stock check + sale header + its one order_items line + initial payment.
+    Caller commits; returns the sale id."""
+    total = data.qty * data.unit_price
+    paid  = min(data.paid_amount, total)
+    due   = total - paid
+    status = "paid" if paid>=total else ("partial" if paid>0 else "unpaid")
+    if data.product_id:
+        prod = db.execute("SELECT * FROM products WHERE id=?", (data.product_id,)).fetchone()
+        if not prod: raise HTTPException(400, f"Product {data.product_id} not found")
+        if prod["qty_available"] < data.qty:
+            raise HTTPException(400, f"Not enough stock. Available: {prod['qty_available']}")
+        db.execute("UPDATE products SET qty_available=qty_available-? WHERE id=?",
+                   (data.qty, data.product_id))
+    if data.customer_phone:
+        if not db.execute("SELECT id FROM customers WHERE phone=?", (data.customer_phone,)).fetchone():
+            db.execute("INSERT INTO customers(name,phone,address) VALUES(?,?,?)",
+                (data.customer_name,data.customer_phone,data.customer_addr))
+    cur = db.execute(
+        "INSERT INTO sales(added_by,date,customer_name,customer_phone,customer_addr,"
+        "product_id,product_name,qty,unit,defined_price,unit_price,total,paid_amount,due_amount,payment_status,notes)"
+        " VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+        (user["id"],data.date,data.customer_name,data.customer_phone,data.customer_addr,
+         data.product_id,data.product_name,data.qty,data.unit or "pcs",data.defined_price,
+         data.unit_price,total,paid,due,status,data.notes))
+    db.execute(
+        "INSERT INTO order_items(sale_id,product_id,product_name,qty,unit,unit_price,total) VALUES(?,?,?,?,?,?,?)",
+        (cur.lastrowid, data.product_id, data.product_name, data.qty, data.unit or "pcs", data.unit_price, total))
+    if paid>0:
+        db.execute(
+            "INSERT INTO sale_payments(sale_id,added_by,amount,date,notes) VALUES(?,?,?,?,?)",
+            (cur.lastrowid,user["id"],paid,data.date, data.payment_notes or "Initial payment"))
+    return cur.lastrowid
+
 @app.post("/api/sales/{sid}/payments", status_code=201)
 def add_sale_payment(sid:int, data:SalePaymentCreate, user=Depends(get_current_user)):
     with get_db() as db:
-        s = db.execute("SELECT * FROM sales WHERE id=?", (sid,)).fetchone()
-        if not s: raise HTTPException(404,"Not found")
-        if s["due_amount"]<=0: raise HTTPException(400,"Already fully paid")
-        payment  = min(data.amount, s["due_amount"])
-        new_paid = s["paid_amount"]+payment
-        new_due  = s["total"]-new_paid
-        db.execute("UPDATE sales SET paid_amount=?,due_amount=?,payment_status=? WHERE id=?",
-            (new_paid,max(0,new_due),"paid" if new_due<=0 else "partial",sid))
-        db.execute("INSERT INTO sale_payments(sale_id,added_by,amount,date,notes) VALUES(?,?,?,?,?)",
-            (sid,user["id"],payment,data.date,data.notes))
+        apply_sale_payment(db, sid, data, user)
         db.commit()
         return dict(db.execute("SELECT * FROM sales WHERE id=?", (sid,)).fetchone())
 
+def apply_sale_payment(db, sid, data, user):
+    """Pay down one sale. Caller commits."""
+    s = db.execute("SELECT * FROM sales WHERE id=?", (sid,)).fetchone()
+    if not s: raise HTTPException(404,"Not found")
+    if s["due_amount"]<=0: raise HTTPException(400,"Already fully paid")
+    payment  = min(data.amount, s["due_amount"])
+    new_paid = s["paid_amount"]+payment
+    new_due  = s["total"]-new_paid
+    db.execute("UPDATE sales SET paid_amount=?,due_amount=?,payment_status=? WHERE id=?",
+        (new_paid,max(0,new_due),"paid" if new_due<=0 else "partial",sid))
+    db.execute("INSERT INTO sale_payments(sale_id,added_by,amount,date,notes) VALUES(?,?,?,?,?)",
+        (sid,user["id"],payment,data.date,data.notes))
+
+@app.post("/api/customers/payments", status_code=201)
+def add_customer_payment(data:CustomerPaymentCreate, user=Depends(get_current_user)):
+    """Spread one lump-sum payment over a customer's open sales — oldest first, or the given sale_ids in order."""
+    if data.amount <= 0: raise HTTPException(400, "Amount must be positive")
+    with get_db() as db:
+        db.execute("BEGIN IMMEDIATE")
+        open_sales = db.execute(
+            "SELECT id,date,total,paid_amount,due_amount FROM sales "
+            "WHERE due_amount>0 AND is_return=0 AND customer_phone=? ORDER BY date, id",
+            (data.customer_phone,)).fetchall()
+        if data.sale_ids:
+            by_id = {s["id"]: s for s in open_sales}
+            missing = [sid for sid in data.sale_ids if sid not in by_id]
+            if missing: raise HTTPException(400, f"Not open sales of this customer: {missing}")
+            open_sales = [by_id[sid] for sid in dict.fromkeys(data.sale_ids)]
+        if not open_sales: raise HTTPException(400, "No outstanding dues for this customer")
+        remaining, allocations, updates, payments = data.amount, [], [], []
+        for s in open_sales:
+            if remaining <= 0: break
+            payment  = min(remaining, s["due_amount"])
+            new_paid = s["paid_amount"]+payment
+            new_due  = max(0, s["total"]-new_paid)
+            status   = "paid" if new_due<=0 else "partial"
+            remaining -= payment
+            updates.append((new_paid, new_due, status, s["id"]))
+            payments.append((s["id"], user["id"], payment, data.date, data.notes))
+            allocations.append({"sale_id":s["id"], "date":s["date"], "amount":payment,
+                                "due_before":s["due_amount"], "due_after":new_due, "payment_status":status})
+        db.executemany("UPDATE sales SET paid_amount=?,due_amount=?,payment_status=? WHERE id=?", updates)
+        db.executemany("INSERT INTO sale_payments(sale_id,added_by,amount,date,notes) VALUES(?,?,?,?,?)", payments)
+        db.commit()
+        return {"customer_phone":data.customer_phone, "amount":data.amount,
+                "allocated":data.amount-remaining, "unallocated":remaining, "allocations":allocations}
+
 @app.get("/api/sales/{sid}/payments")
 def get_sale_payments(sid:int, user=Depends(get_current_user)):
     with get_db() as db:
@@ -688,18 +1494,35 @@ def get_sale_payments(sid:int, user=Depends(get_current_user)):
 @app.post("/api/sales/{sid}/return")
 def return_sale(sid:int, data:SaleReturnCreate, user=Depends(get_current_user)):
     with get_db() as db:
-        s = db.execute("SELECT * FROM sales WHERE id=?", (sid,)).fetchone()
-        if not s: raise HTTPException(404,"Not found")
-        if s["is_return"]: raise HTTPException(400,"Already returned")
-        if s["product_id"]:
-            db.execute("UPDATE products SET qty_available=qty_available+? WHERE id=?", (s["qty"],s["product_id"]))
-        # return_owe = how much we owe back to customer (what they paid minus any restocking or fees)
-        return_owe = data.return_owe if data.return_owe > 0 else data.return_collected
-        db.execute("""UPDATE sales SET is_return=1, return_date=?, return_collected=?, return_owe=?,
-            return_paid_back=0, notes=? WHERE id=?""",
-            (data.date, data.return_collected, return_owe,
-             f"RETURNED on {data.date}: {data.notes or ''}", sid))
-        db.commit(); return dict(db.execute("SELECT * FROM sales WHERE id=?", (sid,)).fetchone())
+        apply_return(db, sid, data, user)
+        db.commit()
+        return dict(db.execute("SELECT * FROM sales WHERE id=?", (sid,)).fetchone())
+
+def apply_return(db, sid, data, user):
+    """Mark a sale returned and restock it. Caller commits."""
+    s = db.execute("SELECT * FROM sales WHERE id=?", (sid,)).fetchone()
+    if not s: raise HTTPException(404,"Not found")
+    if s["is_return"]: raise HTTPException(400,"Already returned")
+    restock_lines(db, sale_lines(db, s))
+    # return_owe = how much we owe back to customer (what they paid minus any restocking or fees)
+    return_owe = data.return_owe if data.return_owe > 0 else data.return_collected
+    db.execute("""UPDATE sales SET is_return=1, return_date=?, return_collected=?, return_owe=?,
+        return_paid_back=0, notes=? WHERE id=?""",
+        (data.date, data.return_collected, return_owe,
+         f"RETURNED on {data.date}: {data.notes or ''}", sid))
+
+def sale_lines(db, s):
+    """order_items lines of a sale. A legacy single-product sale not yet reached by the
+    migration job gets its line written here first."""
+    lines = db.execute("SELECT * FROM order_items WHERE sale_id=? ORDER BY id", (s["id"],)).fetchall()
+    if lines: return lines
+    db.execute("INSERT INTO order_items(sale_id,product_id,product_name,qty,unit,unit_price,total,created_at) "
+               "SELECT id,product_id,product_name,qty,unit,unit_price,total,created_at FROM sales WHERE id=?", (s["id"],))
+    return db.execute("SELECT * FROM order_items WHERE sale_id=? ORDER BY id", (s["id"],)).fetchall()
+
+def restock_lines(db, lines):
+    db.executemany("UPDATE products SET qty_available=qty_available+? WHERE id=?",
+                   [(l["qty"], l["product_id"]) for l in lines if l["product_id"]])
 
 @app.post("/api/sales/{sid}/return-payback")
 def return_payback(sid:int, data:SalePaymentCreate, user=Depends(get_current_user)):
@@ -714,6 +1537,9 @@ def return_payback(sid:int, data:SalePaymentCreate, user=Depends(get_current_use
         payment = min(data.amount, remaining)
         new_paid_back = already_paid_back + payment
         db.execute("UPDATE sales SET return_paid_back=? WHERE id=?", (new_paid_back, sid))
+        if payment > 0:
+            db.execute("INSERT INTO return_paybacks(sale_id,added_by,amount,date,notes) VALUES(?,?,?,?,?)",
+                       (sid, user["id"], payment, data.date, data.notes))
         db.commit(); return dict(db.execute("SELECT * FROM sales WHERE id=?", (sid,)).fetchone())
 
 @app.delete("/api/sales/{sid}")
@@ -722,18 +1548,11 @@ def delete_sale(sid:int, user=Depends(get_current_user)):
         with get_db() as db:
             s = db.execute("SELECT * FROM sales WHERE id=?", (sid,)).fetchone()
             if not s: raise HTTPException(404, "Order not found")
-            # Restore product stock for single-product sale
-            if s["product_id"] and not s["is_return"]:
-                db.execute("UPDATE products SET qty_available=qty_available+? WHERE id=?",
-                           (s["qty"], s["product_id"]))
-            # Restore product stock for each order_item (multi-product order)
-            items = db.execute("SELECT * FROM order_items WHERE sale_id=?", (sid,)).fetchall()
-            for item in items:
-                if item["product_id"] and not s["is_return"]:
-                    db.execute("UPDATE products SET qty_available=qty_available+? WHERE id=?",
-                               (item["qty"], item["product_id"]))
+            # Restore product stock for each line (a returned sale was already restocked)
+            if not s["is_return"]: restock_lines(db, sale_lines(db, s))
             # Delete child rows first (sale_payments has no ON DELETE CASCADE)
             db.execute("DELETE FROM sale_payments WHERE sale_id=?", (sid,))
+            db.execute("DELETE FROM return_paybacks WHERE sale_id=?", (sid,))
             db.execute("DELETE FROM order_items WHERE sale_id=?", (sid,))
             db.execute("DELETE FROM sales WHERE id=?", (sid,))
             db.commit()
@@ -748,84 +1567,254 @@ def delete_sale(sid:int, user=Depends(get_current_user)):
 def create_order(data:OrderCreate, user=Depends(get_current_user)):
     """Create an order with multiple product line items."""
     try:
-        items = data.items or []
-        if not items: raise HTTPException(400, "Order must have at least one item")
-        total = sum(float(i.get("qty",0)) * float(i.get("unit_price",0)) for i in items)
-        paid  = min(data.paid_amount, total)
-        due   = total - paid
-        status = "paid" if paid>=total else ("partial" if paid>0 else "unpaid")
-        product_name = ", ".join(i.get("product_name","") for i in items[:3])
-        if len(items) > 3: product_name += f" +{len(items)-3} more"
-        qty_display = sum(float(i.get("qty",0)) for i in items)
         with get_db() as db:
-            for i in items:
-                pid = i.get("product_id")
-                qty = float(i.get("qty",0))
-                if pid:
-                    prod = db.execute("SELECT * FROM products WHERE id=?", (pid,)).fetchone()
-                    if prod and prod["qty_available"] < qty:
-                        raise HTTPException(400, f"Not enough stock for {i.get('product_name')}. Available: {prod['qty_available']}")
-                    if prod:
-                        db.execute("UPDATE products SET qty_available=qty_available-? WHERE id=?", (qty, pid))
-            if data.customer_phone:
-                if not db.execute("SELECT id FROM customers WHERE phone=?", (data.customer_phone,)).fetchone():
-                    db.execute("INSERT INTO customers(name,phone,address) VALUES(?,?,?)",
-                        (data.customer_name, data.customer_phone, data.customer_addr))
-            cur = db.execute(
-                "INSERT INTO sales(added_by,date,customer_name,customer_phone,customer_addr,"
-                "product_id,product_name,qty,unit,defined_price,unit_price,total,paid_amount,due_amount,payment_status,notes)"
-                " VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
-                (user["id"],data.date,data.customer_name,data.customer_phone,data.customer_addr,
-                 None,product_name,qty_display,"pcs",0,total/qty_display if qty_display>0 else 0,
-                 total,paid,due,status,data.notes))
-            sale_id = cur.lastrowid
-            for i in items:
-                db.execute(
-                    "INSERT INTO order_items(sale_id,product_id,product_name,qty,unit,unit_price,total) VALUES(?,?,?,?,?,?,?)",
-                    (sale_id, i.get("product_id"), i.get("product_name",""), float(i.get("qty",0)),
-                     "pcs", float(i.get("unit_price",0)),
-                     float(i.get("qty",0))*float(i.get("unit_price",0))))
-            if paid>0:
-                db.execute(
-                    "INSERT INTO sale_payments(sale_id,added_by,amount,date,notes) VALUES(?,?,?,?,?)",
-                    (sale_id,user["id"],paid,data.date, data.payment_notes or "Initial payment"))
+            sid = insert_order(db, data, user)
             db.commit()
-            return dict(db.execute("SELECT * FROM sales WHERE id=?", (sale_id,)).fetchone())
+            return dict(db.execute("SELECT * FROM sales WHERE id=?", (sid,)).fetchone())
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(500, f"Failed to create order: {str(e)}")
+
+def insert_order(db, data, user):
+    """Stock checks + sale header + order_items + initial payment. Caller commits; returns the sale id."""
+    items = data.items or []
+    if not items: raise HTTPException(400, "Order must have at least one item")
+    if not all(isinstance(i, dict) for i in items): raise HTTPException(400, "Each order item must be an object")
+    total = sum(float(i.get("qty",0)) * float(i.get("unit_price",0)) for i in items)
+    paid  = min(data.paid_amount, total)
+    due   = total - paid
+    status = "paid" if paid>=total else ("partial" if paid>0 else "unpaid")
+    product_name = ", ".join(i.get("product_name","") for i in items[:3])
+    if len(items) > 3: product_name += f" +{len(items)-3} more"
+    qty_display = sum(float(i.get("qty",0)) for i in items)
+    for i in items:
+        pid = i.get("product_id")
+        qty = float(i.get("qty",0))
+        if pid:
+            prod = db.execute("SELECT * FROM products WHERE id=?", (pid,)).fetchone()
+            if not prod: raise HTTPException(400, f"Product {pid} not found ({i.get('product_name')})")
+            if prod["qty_available"] < qty:
+                raise HTTPException(400, f"Not enough stock for {i.get('product_name')}. Available: {prod['qty_available']}")
+            db.execute("UPDATE products SET qty_available=qty_available-? WHERE id=?", (qty, pid))
+    if data.customer_phone:
+        if not db.execute("SELECT id FROM customers WHERE phone=?", (data.customer_phone,)).fetchone():
+            db.execute("INSERT INTO customers(name,phone,address) VALUES(?,?,?)",
+                (data.customer_name, data.customer_phone, data.customer_addr))
+    cur = db.execute(
+        "INSERT INTO sales(added_by,date,customer_name,customer_phone,customer_addr,"
+        "product_id,product_name,qty,unit,defined_price,unit_price,total,paid_amount,due_amount,payment_status,notes)"
+        " VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+        (user["id"],data.date,data.customer_name,data.customer_phone,data.customer_addr,
+         None,product_name,qty_display,"pcs",0,total/qty_display if qty_display>0 else 0,
+         total,paid,due,status,data.notes))
+    sale_id = cur.lastrowid
+    for i in items:
+        db.execute(
+            "INSERT INTO order_items(sale_id,product_id,product_name,qty,unit,unit_price,total) VALUES(?,?,?,?,?,?,?)",
+            (sale_id, i.get("product_id"), i.get("product_name",""), float(i.get("qty",0)),
+             "pcs", float(i.get("unit_price",0)),
+             float(i.get("qty",0))*float(i.get("unit_price",0))))
+    if paid>0:
+        db.execute(
+            "INSERT INTO sale_payments(sale_id,added_by,amount,date,notes) VALUES(?,?,?,?,?)",
+            (sale_id,user["id"],paid,data.date, data.payment_notes or "Initial payment"))
+    return sale_id
 @app.get("/api/orders/{sid}/items")
 def get_order_items(sid:int, user=Depends(get_current_user)):
     with get_db() as db:
         return [dict(r) for r in db.execute("SELECT * FROM order_items WHERE sale_id=? ORDER BY id",(sid,)).fetchall()]
 
+# ── Offline sync ──────────────────────────────────────────────
+# A till queues mutations while offline and flushes them here in one request. Ops run in
+# order inside one transaction, each under its own SAVEPOINT so a conflict (e.g. not enough
+# stock) only drops that op. Outcomes are stored per (client_id, op_id), so re-sending a batch
+# after a lost response replays results instead of applying twice. Later ops can point at an
+# earlier op's new row with `ref` (e.g. a payment on an order created offline).
+SYNC_MAX_OPS   = 500
+SYNC_DELTA_MAX = 1000       # changed rows per response; the client calls again while "more"
+SYNC_LOG_KEEP  = 200000     # change-log rows kept; older (and new) clients get full_resync
+# type -> (model, applier, target id key for ops that act on an existing row)
+SYNC_HANDLERS = {
+    "order":            (OrderCreate,           insert_order,           None),
+    "sale":             (SaleCreate,            insert_sale,            None),
+    "purchase":         (PurchaseCreate,        insert_purchase,        None),
+    "sale_payment":     (SalePaymentCreate,     apply_sale_payment,     "sale_id"),
+    "purchase_payment": (PurchasePaymentCreate, apply_purchase_payment, "purchase_id"),
+    "return":           (SaleReturnCreate,      apply_return,           "sale_id"),
+}
+
+def _apply_sync_op(db, op, user, resolved):
+    if op.type not in SYNC_HANDLERS: raise ValueError(f"Unknown op type '{op.type}'")
+    model, apply, target = SYNC_HANDLERS[op.type]
+    data = model(**op.data)
+    if not target: return apply(db, data, user)
+    tid = op.data.get(target) or resolved.get(op.ref)
+    if not tid: raise HTTPException(400, f"'{op.type}' needs {target} or a ref to an applied op")
+    apply(db, tid, data, user)
+    return tid
+
+def sync_delta(db, since):
+    """Rows of SYNC_TABLES changed after version `since` (current state), plus ids deleted since."""
+    floor, top = db.execute("SELECT MIN(version), COALESCE(MAX(version),0) FROM changes").fetchone()
+    # A new till (since=0) must snapshot: rows older than the triggers or pruned off the log never
+    # appear in it. Same for a version the log has been pruned past, or one from another database.
+    if since <= 0 or since > top or (floor is not None and since < floor - 1):
+        return {"version": top, "full_resync": True, "changes": {}, "deleted": {}, "more": False}
+    log = db.execute("SELECT version, tbl, row_id FROM changes WHERE version>? ORDER BY version LIMIT ?",
+                     (since, SYNC_DELTA_MAX)).fetchall()
+    ids = {}
+    for r in log: ids.setdefault(r["tbl"], set()).add(r["row_id"])
+    changes, deleted = {}, {}
+    for tbl, wanted in ids.items():
+        cols = PURCHASE_LIST_COLS if tbl == "purchases" else "*"
+        rows = [dict(r) for r in db.execute(
+            f"SELECT {cols} FROM {tbl} WHERE id IN ({','.join('?'*len(wanted))})", tuple(wanted)).fetchall()]
+        changes[tbl] = rows
+        gone = wanted - {r["id"] for r in rows}
+        if gone: deleted[tbl] = sorted(gone)
+    return {"version": log[-1]["version"] if log else since, "full_resync": False,
+            "changes": changes, "deleted": deleted, "more": len(log) == SYNC_DELTA_MAX}
+
+@app.post("/api/sync")
+def sync(data:SyncRequest, user=Depends(get_current_user)):
+    """Apply a till's queued mutations, then return the server changes since its last version."""
+    if len(data.ops) > SYNC_MAX_OPS: raise HTTPException(400, f"At most {SYNC_MAX_OPS} ops per sync")
+    results, resolved = [], {}
+    with get_db() as db:
+        db.execute("BEGIN IMMEDIATE")
+        for op in data.ops:
+            prev = db.execute("SELECT * FROM sync_ops WHERE client_id=? AND op_id=?", (data.client_id, op.op_id)).fetchone()
+            if prev:
+                res = {"op_id": op.op_id, "status": prev["status"], "id": prev["server_id"], "detail": prev["detail"], "replayed": True}
+            else:
+                if op.ref and op.ref not in resolved:
+                    ref = db.execute("SELECT server_id FROM sync_ops WHERE client_id=? AND op_id=? AND status='applied'",
+                                     (data.client_id, op.ref)).fetchone()
+                    if ref: resolved[op.ref] = ref["server_id"]
+                db.execute("SAVEPOINT sync_op")
+                try:
+                    res = {"op_id": op.op_id, "status": "applied", "id": _apply_sync_op(db, op, user, resolved), "detail": None}
+                except sqlite3.OperationalError: raise   # locked / over deadline: the whole batch is retried
+                except Exception as e:   # one bad op (FK failure, malformed item, ...) must not block the queue
+                    db.execute("ROLLBACK TO sync_op")
+                    res = {"op_id": op.op_id, "id": None,
+                           "status": "conflict" if isinstance(e, (HTTPException, sqlite3.IntegrityError)) else "error",
+                           "detail": e.detail if isinstance(e, HTTPException) else
+                                     "; ".join(f"{'.'.join(map(str, x['loc']))}: {x['msg']}" for x in e.errors())
+                                     if isinstance(e, ValidationError) else str(e)}
+                db.execute("RELEASE sync_op")
+                db.execute("INSERT INTO sync_ops(client_id,op_id,status,server_id,detail,created_at) VALUES(?,?,?,?,?,?)",
+                    (data.client_id, op.op_id, res["status"], res["id"], res["detail"], time.time()))
+            if res["status"] == "applied": resolved[op.op_id] = res["id"]
+            results.append(res)
+        db.execute("DELETE FROM sync_ops WHERE created_at < ?", (time.time() - IDEMPOTENCY_TTL,))
+        db.execute("DELETE FROM changes WHERE version <= (SELECT MAX(version) FROM changes) - ?", (SYNC_LOG_KEEP,))
+        db.commit()
+        return {"results": results, **sync_delta(db, data.since)}
+
 # ── Analytics (Admin only) ────────────────────────────────────
 @app.get("/api/analytics/summary")
-def get_summary(admin=Depends(require_admin)):
+def get_summary(request:Request, admin=Depends(require_admin)):
+    return response_cache.get(cache_key(request, admin), ("purchases","sales","order_items"), _summary)
+
+def _summary():
     with get_db() as db:
-        def q(sql): return db.execute(sql).fetchone()[0]
-        top_sup  = db.execute("SELECT supplier_name,SUM(total) as t FROM purchases GROUP BY supplier_name ORDER BY t DESC LIMIT 1").fetchone()
-        top_cust = db.execute("SELECT customer_name,SUM(total) as t FROM sales WHERE is_return=0 GROUP BY customer_name ORDER BY t DESC LIMIT 1").fetchone()
-        top_prod = db.execute("SELECT product_name,SUM(total) as t FROM sales WHERE is_return=0 GROUP BY product_name ORDER BY t DESC LIMIT 1").fetchone()
-        return {
-            "totalPurchases": q("SELECT COALESCE(SUM(total),0) FROM purchases"),
-            "purchasePaid":   q("SELECT COALESCE(SUM(paid_amount),0) FROM purchases"),
-            "purchaseDue":    q("SELECT COALESCE(SUM(due_amount),0) FROM purchases"),
-            "totalSales":     q("SELECT COALESCE(SUM(total),0) FROM sales WHERE is_return=0"),
-            "saleCollected":  q("SELECT COALESCE(SUM(paid_amount),0) FROM sales WHERE is_return=0"),
-            "saleDue":        q("SELECT COALESCE(SUM(due_amount),0) FROM sales WHERE is_return=0"),
-            "profit":         q("SELECT COALESCE(SUM(paid_amount),0) FROM sales WHERE is_return=0") - q("SELECT COALESCE(SUM(paid_amount),0) FROM purchases"),
-            "purchaseCount":  q("SELECT COUNT(*) FROM purchases"),
-            "saleCount":      q("SELECT COUNT(*) FROM sales WHERE is_return=0"),
-            "returnsCount":   q("SELECT COUNT(*) FROM sales WHERE is_return=1"),
-            "topSupplier":  dict(top_sup)  if top_sup  else None,
-            "topCustomer":  dict(top_cust) if top_cust else None,
-            "topProduct":   dict(top_prod) if top_prod else None,
-        }
+        return summary_numbers(db)
+
+def summary_numbers(db):
+    def q(sql): return db.execute(sql).fetchone()[0]
+    def top(dim, name):
+        rows = leaderboard(db, dim, limit=1)
+        return {name: rows[0]["label"], "t": rows[0]["amount"]} if rows else None
+    return {
+        "totalPurchases": q("SELECT COALESCE(SUM(total),0) FROM purchases"),
+        "purchasePaid":   q("SELECT COALESCE(SUM(paid_amount),0) FROM purchases"),
+        "purchaseDue":    q("SELECT COALESCE(SUM(due_amount),0) FROM purchases"),
+        "totalSales":     q("SELECT COALESCE(SUM(total),0) FROM sales WHERE is_return=0"),
+        "saleCollected":  q("SELECT COALESCE(SUM(paid_amount),0) FROM sales WHERE is_return=0"),
+        "saleDue":        q("SELECT COALESCE(SUM(due_amount),0) FROM sales WHERE is_return=0"),
+        "profit":         q("SELECT COALESCE(SUM(paid_amount),0) FROM sales WHERE is_return=0") - q("SELECT COALESCE(SUM(paid_amount),0) FROM purchases"),
+        "purchaseCount":  q("SELECT COUNT(*) FROM purchases"),
+        "saleCount":      q("SELECT COUNT(*) FROM sales WHERE is_return=0"),
+        "returnsCount":   q("SELECT COUNT(*) FROM sales WHERE is_return=1"),
+        "topSupplier":  top("supplier", "supplier_name"),
+        "topCustomer":  top("customer", "customer_name"),
+        "topProduct":   top("product", "product_name"),
+    }
+
+def _shop_summary(shop):
+    try:
+        with get_db(shop) as db: return {"shop": shop, **summary_numbers(db)}
+    except Exception as e:
+        return {"shop": shop, "error": str(e)}
+
+@app.post("/admin/shops/report")
+def shops_report(req:ShopsReportReq):
+    """Summary for every shop, each read in parallel on its own database."""
+    if req.password!=ADMIN_PASSWORD: return {"error":"Wrong password"}
+    with ThreadPoolExecutor(max_workers=min(8, len(SHOPS))) as ex:
+        shops = list(ex.map(_shop_summary, SHOPS))
+    totals = {k: sum(s.get(k, 0) for s in shops) for k in
+              ("totalPurchases","purchaseDue","totalSales","saleDue","profit","saleCount","purchaseCount")}
+    return {"shops": shops, "totals": totals}
+
+@app.get("/api/analytics/products")
+def get_product_sales(request:Request, date_from:Optional[str]=None, date_to:Optional[str]=None, admin=Depends(require_admin)):
+    """Per-product quantity and revenue from order lines (returns excluded)."""
+    def load():
+        where, args = "s.is_return=0", ()
+        if date_from: where += " AND s.date>=?"; args += (date_from,)
+        if date_to:   where += " AND s.date<=?"; args += (date_to,)
+        with get_db() as db:
+            return [dict(r) for r in db.execute(
+                "SELECT oi.product_id, oi.product_name, SUM(oi.qty) as qty, SUM(oi.total) as revenue, "
+                "COUNT(DISTINCT oi.sale_id) as orders FROM order_items oi JOIN sales s ON s.id=oi.sale_id "
+                f"WHERE {where} GROUP BY COALESCE(oi.product_id, oi.product_name) ORDER BY revenue DESC", args).fetchall()]
+    return response_cache.get(cache_key(request, admin), ("sales","order_items"), load)
+
+LEADERBOARD_DIMS    = {"customers": "customer", "products": "product", "suppliers": "supplier", "staff": "staff"}
+LEADERBOARD_WINDOWS = {"today": 0, "7d": 6, "30d": 29}   # days back from today, inclusive
+LEADERBOARD_SORTS   = ("amount", "qty", "count")
+
+def leaderboard(db, dim, date_from=None, date_to=None, limit=10, sort="amount"):
+    """Top keys of one daily_totals dimension over [date_from, date_to] (open-ended if None)."""
+    where, args = "dim=?", [dim]
+    if date_from: where += " AND day>=?"; args.append(date_from)
+    if date_to:   where += " AND day<=?"; args.append(date_to)
+    rows = [dict(r) for r in db.execute(
+        "SELECT key, MAX(label) as label, SUM(amount) as amount, SUM(qty) as qty, SUM(cnt) as count "
+        f"FROM daily_totals WHERE {where} GROUP BY key HAVING SUM(cnt)>0 ORDER BY {sort} DESC LIMIT ?",
+        args + [limit]).fetchall()]
+    if dim == "staff" and rows:
+        names = dict(db.execute(f"SELECT CAST(id AS TEXT), name FROM users WHERE id IN ({','.join('?'*len(rows))})",
+                                [r["key"] for r in rows]).fetchall())
+        for r in rows: r["label"] = names.get(r["key"])
+    return rows
+
+@app.get("/api/analytics/leaderboard")
+def get_leaderboard(request:Request, dim:str="customers", window:str="30d", date_from:Optional[str]=None,
+                    date_to:Optional[str]=None, limit:int=10, sort:str="amount", admin=Depends(require_admin)):
+    """Top-K customers / products / suppliers / staff (by added_by) for today, 7d, 30d, all or a custom range."""
+    if dim not in LEADERBOARD_DIMS: raise HTTPException(400, f"Unknown dim. Use one of: {', '.join(LEADERBOARD_DIMS)}")
+    if sort not in LEADERBOARD_SORTS: raise HTTPException(400, f"Unknown sort. Use one of: {', '.join(LEADERBOARD_SORTS)}")
+    today = datetime.now().date()
+    if window in LEADERBOARD_WINDOWS:
+        date_from, date_to = (today - timedelta(days=LEADERBOARD_WINDOWS[window])).isoformat(), today.isoformat()
+    elif window == "all": date_from = date_to = None
+    elif window != "custom": raise HTTPException(400, "Unknown window. Use today, 7d, 30d, all or custom")
+    elif not (date_from or date_to): raise HTTPException(400, "custom window needs date_from and/or date_to")
+    def load():
+        with get_db() as db:
+            return {"dim": dim, "window": window, "date_from": date_from, "date_to": date_to,
+                    "rows": leaderboard(db, LEADERBOARD_DIMS[dim], date_from, date_to, max(1, min(limit, 100)), sort)}
+    return response_cache.get(f"{cache_key(request, admin)}|{today}", ("sales","order_items","purchases","users"), load)
 
 @app.get("/api/analytics/monthly")
-def get_monthly(admin=Depends(require_admin)):
+def get_monthly(request:Request, admin=Depends(require_admin)):
+    return response_cache.get(cache_key(request, admin), ("purchases","sales"), _monthly)
+
+def _monthly():
     with get_db() as db:
         p = db.execute("SELECT strftime('%Y-%m',date) as m,SUM(total) as t,SUM(paid_amount) as paid FROM purchases GROUP BY m").fetchall()
         s = db.execute("SELECT strftime('%Y-%m',date) as m,SUM(total) as t,SUM(paid_amount) as collected FROM sales WHERE is_return=0 GROUP BY m").fetchall()
@@ -839,26 +1828,158 @@ def get_monthly(admin=Depends(require_admin)):
             m["profit"]=m["collected"]-m["purchase_paid"]; result.append(m)
         return result
 
+# ── Dues & Aging ──────────────────────────────────────────────
+# Purchase columns without image_data — dues lists never show the picture
+PURCHASE_LIST_COLS = ("id,added_by,date,supplier_name,item,qty,unit,unit_cost,total,paid_amount,"
+                      "due_amount,payment_status,low_stock_alert,image_name,notes,created_at")
+# Age (in days) of an outstanding row, measured from its date column
+AGING_BUCKETS = {"0-30":(0,30), "31-60":(31,60), "61-90":(61,90), "90+":(91,None)}
+AGE_SQL = "CAST(julianday('now') - julianday(date) AS INTEGER)"
+
+def aging_filter(bucket):
+    """SQL fragment + params restricting rows to one aging bucket."""
+    if not bucket: return "", ()
+    if bucket not in AGING_BUCKETS: raise HTTPException(400, f"Unknown bucket. Use one of: {', '.join(AGING_BUCKETS)}")
+    lo, hi = AGING_BUCKETS[bucket]
+    if hi is None: return f" AND {AGE_SQL} >= ?", (lo,)
+    return f" AND {AGE_SQL} BETWEEN ? AND ?", (lo, hi)
+
+def page_clause(limit, offset):
+    """LIMIT/OFFSET fragment. No limit keeps the old 'return everything' behaviour."""
+    if limit is None: return "", ()
+    return " LIMIT ? OFFSET ?", (max(1, min(limit, 500)), max(0, offset))
+
+def aging_rows(db, table, key_cols, where, limit, offset):
+    """Aggregate outstanding amounts per key into 0-30/31-60/61-90/90+ buckets."""
+    buckets = ",".join(
+        f"SUM(CASE WHEN age >= {lo}{f' AND age <= {hi}' if hi is not None else ''} THEN due ELSE 0 END) as \"{name}\""
+        for name,(lo,hi) in AGING_BUCKETS.items())
+    pg, pg_args = page_clause(limit, offset)
+    return [dict(r) for r in db.execute(
+        f"SELECT {key_cols}, COUNT(*) as count, SUM(due) as total_due, MIN(date) as oldest, {buckets} "
+        f"FROM (SELECT {key_cols}, date, due_amount as due, {AGE_SQL} as age FROM {table} WHERE {where}) "
+        f"GROUP BY {key_cols} ORDER BY total_due DESC{pg}", pg_args).fetchall()]
+
 @app.get("/api/analytics/dues")
-def get_dues(user=Depends(get_current_user)):
+def get_dues(customer_phone:Optional[str]=None, customer_name:Optional[str]=None, bucket:Optional[str]=None,
+             limit:Optional[int]=None, offset:int=0, user=Depends(get_current_user)):
+    where, args = aging_filter(bucket)
+    if customer_phone: where += " AND customer_phone=?"; args += (customer_phone,)
+    if customer_name:  where += " AND customer_name=?";  args += (customer_name,)
+    pg, pg_args = page_clause(limit, offset)
     with get_db() as db:
-        return [dict(r) for r in db.execute("SELECT * FROM sales WHERE due_amount>0 AND is_return=0 ORDER BY date").fetchall()]
+        return [dict(r) for r in db.execute(
+            f"SELECT * FROM sales WHERE due_amount>0 AND is_return=0{where} ORDER BY date{pg}", args+pg_args).fetchall()]
 
 @app.get("/api/analytics/purchase-dues")
-def get_purchase_dues(user=Depends(get_current_user)):
+def get_purchase_dues(supplier_name:Optional[str]=None, bucket:Optional[str]=None,
+                      limit:Optional[int]=None, offset:int=0, user=Depends(get_current_user)):
+    where, args = aging_filter(bucket)
+    if supplier_name: where += " AND supplier_name=?"; args += (supplier_name,)
+    pg, pg_args = page_clause(limit, offset)
     with get_db() as db:
-        return [dict(r) for r in db.execute("SELECT * FROM purchases WHERE due_amount>0 ORDER BY date").fetchall()]
+        return [dict(r) for r in db.execute(
+            f"SELECT {PURCHASE_LIST_COLS} FROM purchases WHERE due_amount>0{where} ORDER BY date{pg}", args+pg_args).fetchall()]
 
 @app.get("/api/analytics/return-dues")
-def get_return_dues(user=Depends(get_current_user)):
+def get_return_dues(limit:Optional[int]=None, offset:int=0, user=Depends(get_current_user)):
     """Sales that are returned and we still owe money back to customer."""
+    pg, pg_args = page_clause(limit, offset)
     with get_db() as db:
         return [dict(r) for r in db.execute(
-            "SELECT * FROM sales WHERE is_return=1 AND return_owe > return_paid_back ORDER BY return_date DESC"
+            f"SELECT * FROM sales WHERE is_return=1 AND return_owe > return_paid_back ORDER BY return_date DESC{pg}", pg_args
         ).fetchall()]
 
+@app.get("/api/analytics/aging/customers")
+def get_customer_aging(limit:int=50, offset:int=0, user=Depends(get_current_user)):
+    """Receivables per customer, bucketed by age. Drill down with /api/analytics/dues?customer_phone=&bucket=."""
+    with get_db() as db:
+        return aging_rows(db, "sales", "customer_phone,customer_name", "due_amount>0 AND is_return=0", limit, offset)
+
+@app.get("/api/analytics/aging/suppliers")
+def get_supplier_aging(limit:int=50, offset:int=0, user=Depends(get_current_user)):
+    """Payables per supplier, bucketed by age. Drill down with /api/analytics/purchase-dues?supplier_name=&bucket=."""
+    with get_db() as db:
+        return aging_rows(db, "purchases", "supplier_name", "due_amount>0", limit, offset)
+
+# ── Statements ────────────────────────────────────────────────
+# One chronological ledger per customer (by phone) or supplier, merged from the per-account
+# indexes. Rows are ordered by (date, ord, id); `balance` is a running SUM() window. Pages are
+# keyset-paginated: the cursor carries the last row's sort key and balance, so a page only
+# reads the rows after it and continues the balance from there.
+# Customer balance: what the customer owes us (negative once we owe them after a return).
+CUSTOMER_LEDGER = """
+    SELECT s.date as date, 0 as ord, s.id as id, 'sale' as kind, s.id as sale_id, s.product_name as description,
+           s.total as debit, 0 as credit
+      FROM sales s WHERE s.customer_phone=:key AND s.date>=:since
+    UNION ALL
+    SELECT p.date, 1, p.id, 'payment', p.sale_id, p.notes, 0, p.amount
+      FROM sale_payments p JOIN sales s ON s.id=p.sale_id WHERE s.customer_phone=:key AND p.date>=:since
+    UNION ALL
+    SELECT s.return_date, 2, s.id, 'return', s.id, s.notes, 0, s.total - s.paid_amount + s.return_owe
+      FROM sales s WHERE s.customer_phone=:key AND s.is_return=1 AND s.return_date>=:since
+    UNION ALL
+    SELECT b.date, 3, b.id, 'payback', b.sale_id, b.notes, b.amount, 0
+      FROM return_paybacks b JOIN sales s ON s.id=b.sale_id WHERE s.customer_phone=:key AND b.date>=:since
+"""
+# Supplier balance: what we still owe the supplier.
+SUPPLIER_LEDGER = """
+    SELECT p.date as date, 0 as ord, p.id as id, 'purchase' as kind, p.id as purchase_id, p.item as description,
+           p.total as debit, 0 as credit
+      FROM purchases p WHERE p.supplier_name=:key AND p.date>=:since
+    UNION ALL
+    SELECT pp.date, 1, pp.id, 'payment', pp.purchase_id, pp.notes, 0, pp.amount
+      FROM purchase_payments pp JOIN purchases p ON p.id=pp.purchase_id WHERE p.supplier_name=:key AND pp.date>=:since
+"""
+
+def ledger_page(db, ledger, key, date_from, date_to, cursor, limit):
+    """One page of a ledger. Without a cursor the opening balance is everything before date_from."""
+    if cursor:
+        try:
+            d, o, i, opening = cursor.split("|")
+            after, opening = (d, int(o), int(i)), float(opening)
+        except ValueError: raise HTTPException(400, "Invalid cursor")
+    else:
+        after, opening = (date_from or "", -1, 0), 0.0
+        if date_from:
+            opening = db.execute(f"SELECT COALESCE(SUM(debit-credit),0) FROM ({ledger}) WHERE date<:df",
+                                 {"key": key, "since": "", "df": date_from}).fetchone()[0]
+    limit = max(1, min(limit, 500))
+    rows = [dict(r) for r in db.execute(f"""
+        SELECT *, :opening + SUM(debit-credit) OVER (ORDER BY date, ord, id ROWS UNBOUNDED PRECEDING) as balance
+        FROM ({ledger}) WHERE (date, ord, id) > (:d, :o, :i) AND (:until IS NULL OR date<=:until)
+        ORDER BY date, ord, id LIMIT :lim""",
+        {"key": key, "since": after[0], "d": after[0], "o": after[1], "i": after[2],
+         "until": date_to, "opening": opening, "lim": limit + 1}).fetchall()]
+    more, rows = len(rows) > limit, rows[:limit]
+    last = rows[-1] if rows else None
+    nxt = f"{last['date']}|{last['ord']}|{last['id']}|{last['balance']}" if more else None
+    for r in rows: del r["ord"]
+    return {"opening_balance": opening, "closing_balance": last["balance"] if last else opening,
+            "entries": rows, "next_cursor": nxt}
+
+@app.get("/api/statements/customer")
+def customer_statement(customer_phone:str, date_from:Optional[str]=None, date_to:Optional[str]=None,
+                       cursor:Optional[str]=None, limit:int=100, user=Depends(get_current_user)):
+    """Sales, payments, returns and paybacks of one customer with a running balance.
+    Pass next_cursor back as `cursor` for the following page."""
+    with get_db() as db:
+        return {"customer_phone": customer_phone,
+                **ledger_page(db, CUSTOMER_LEDGER, customer_phone, date_from, date_to, cursor, limit)}
+
+@app.get("/api/statements/supplier")
+def supplier_statement(supplier_name:str, date_from:Optional[str]=None, date_to:Optional[str]=None,
+                       cursor:Optional[str]=None, limit:int=100, user=Depends(get_current_user)):
+    """Purchases and payments of one supplier with a running balance (what we still owe)."""
+    with get_db() as db:
+        return {"supplier_name": supplier_name,
+                **ledger_page(db, SUPPLIER_LEDGER, supplier_name, date_from, date_to, cursor, limit)}
+
 @app.get("/api/analytics/inventory")
-def get_inventory(user=Depends(get_current_user)):
+def get_inventory(request:Request, user=Depends(get_current_user)):
+    return response_cache.get(cache_key(request, user), ("raw_items","purchases","product_ingredients"), _inventory)
+
+def _inventory():
     with get_db() as db:
         # Only show items that have at least one existing purchase record
         return [dict(r) for r in db.execute("""
@@ -876,6 +1997,729 @@ def get_inventory(user=Depends(get_current_user)):
             WHERE COALESCE(p.qty,0) > 0
         """).fetchall()]
 
+# ── Stock alerts ──────────────────────────────────────────────
+ALERT_POLL_SEC      = 1
+ALERT_KEEPALIVE_SEC = 15
+
+@app.get("/api/alerts")
+def list_alerts(request:Request, user=Depends(get_current_user)):
+    """Items currently at or below their threshold, newest crossing first."""
+    return response_cache.get(cache_key(request, user), ("stock_alerts","raw_items","products"), _alerts)
+
+def _alerts():
+    with get_db() as db:
+        return [dict(r) for r in db.execute("""
+            SELECT a.id, a.kind, a.ref_id, a.name, a.threshold, a.created_at,
+                CASE a.kind WHEN 'raw_item' THEN (SELECT available FROM raw_items WHERE id=a.ref_id)
+                            ELSE (SELECT qty_available FROM products WHERE id=a.ref_id) END as level
+            FROM stock_alerts a
+            JOIN (SELECT MAX(id) as id FROM stock_alerts GROUP BY kind, ref_id) latest ON latest.id = a.id
+            WHERE a.state = 'low' ORDER BY a.id DESC
+        """).fetchall()]
+
+@app.get("/api/alerts/events")
+def list_alert_events(since:int=0, limit:int=100, user=Depends(get_current_user)):
+    """Crossing log (both 'low' and 'ok') after event id `since`."""
+    with get_db() as db:
+        return [dict(r) for r in db.execute("SELECT * FROM stock_alerts WHERE id>? ORDER BY id LIMIT ?",
+                                            (since, max(1, min(limit, 500)))).fetchall()]
+
+@app.get("/api/alerts/stream")
+async def stream_alerts(request:Request, user=Depends(get_current_user)):
+    """Server-sent events: one `alert` event per crossing. Resumes after Last-Event-ID.
+    Between writes this only polls the cached table generation, not SQLite."""
+    shop = current_shop.get()
+    def newer(last):
+        with get_db(shop) as db:
+            return [dict(r) for r in db.execute("SELECT * FROM stock_alerts WHERE id>? ORDER BY id LIMIT 100", (last,)).fetchall()]
+    def latest_id():
+        with get_db(shop) as db: return db.execute("SELECT COALESCE(MAX(id),0) FROM stock_alerts").fetchone()[0]
+    last = request.headers.get("last-event-id")
+    last = int(last) if last and last.isdigit() else await run_in_threadpool(latest_id)
+    async def events():
+        nonlocal last
+        seen, idle = None, 0.0
+        yield ": connected\n\n"
+        while not await request.is_disconnected():
+            version = await run_in_threadpool(response_cache.version, shop, "stock_alerts")
+            if version != seen:
+                seen = version
+                for a in await run_in_threadpool(newer, last):
+                    last = a["id"]
+                    yield f"id: {a['id']}\nevent: alert\ndata: {json.dumps(a)}\n\n"
+            idle += ALERT_POLL_SEC
+            if idle >= ALERT_KEEPALIVE_SEC: idle = 0.0; yield ": keepalive\n\n"
+            await asyncio.sleep(ALERT_POLL_SEC)
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.put("/api/products/{pid}/threshold")
+def set_product_threshold(pid:int, data:StockThresholdUpdate, user=Depends(get_current_user)):
+    with get_db() as db:
+        if not db.execute("UPDATE products SET low_stock_threshold=? WHERE id=?", (data.low_stock_threshold, pid)).rowcount:
+            raise HTTPException(404,"Not found")
+        db.commit()
+        return dict(db.execute("SELECT * FROM products WHERE id=?", (pid,)).fetchone())
+
+@app.put("/api/raw-items/{rid}/threshold")
+def set_raw_item_threshold(rid:int, data:StockThresholdUpdate, user=Depends(get_current_user)):
+    with get_db() as db:
+        if not db.execute("UPDATE raw_items SET low_stock_threshold=? WHERE id=?", (data.low_stock_threshold, rid)).rowcount:
+            raise HTTPException(404,"Not found")
+        db.commit()
+        return dict(db.execute("SELECT * FROM raw_items WHERE id=?", (rid,)).fetchone())
+
+@app.get("/api/admin/cache")
+def get_cache_stats(admin=Depends(require_admin)):
+    return response_cache.stats()
+
+@app.get("/api/admin/admission")
+def get_admission_stats(admin=Depends(require_admin)):
+    """Per-class admission counters and queue-time percentiles for this worker."""
+    return {name: gate.stats() for name, gate in admission_gates.items()}
+
+# ── Backups ───────────────────────────────────────────────────
+# Online snapshots through the sqlite3 backup API, copied BACKUP_STEP_PAGES at a time so
+# writers only ever wait for one short step. Snapshots are gzipped, with a sha256sum-style
+# sidecar, and the newest BACKUP_KEEP per shop are kept. Status lives in the shop's `meta`
+# table and a flock on BACKUP_DIR/.<shop>.lock marks a running copy, so every worker process
+# sees the same state and only one can snapshot a shop at a time.
+BACKUP_DIR          = os.getenv("BACKUP_DIR", os.path.join(TENANT_DIR, "backups"))
+BACKUP_INTERVAL_MIN = int(os.getenv("BACKUP_INTERVAL_MIN", "360"))   # 0 disables the scheduler
+BACKUP_KEEP         = int(os.getenv("BACKUP_KEEP", "14"))
+BACKUP_STEP_PAGES   = int(os.getenv("BACKUP_STEP_PAGES", "256"))
+BACKUP_MAX_RESTARTS = 5
+backup_progress = {}        # shop -> {"pages_done", "pages_total"} of a copy running in this worker
+
+class _BackupRestarted(Exception): pass
+
+def _copy_db(src_path, dest_path, state):
+    """Page-stepped online copy. A commit from another connection restarts the copy, so after a
+    few restarts fall back to one step — in WAL mode that only holds a read snapshot."""
+    src, dest = sqlite3.connect(src_path), sqlite3.connect(dest_path)
+    restarts, last = [0], [None]
+    def progress(status, remaining, total):
+        state["pages_done"], state["pages_total"] = total-remaining, total
+        if last[0] is not None and remaining > last[0]:
+            restarts[0] += 1
+            if restarts[0] > BACKUP_MAX_RESTARTS: raise _BackupRestarted()
+        last[0] = remaining
+    try:
+        try: src.backup(dest, pages=BACKUP_STEP_PAGES, progress=progress)
+        except _BackupRestarted: src.backup(dest, pages=-1)
+        check = dest.execute("PRAGMA quick_check").fetchone()[0]
+        if check != "ok": raise RuntimeError(f"Snapshot failed quick_check: {check}")
+    finally:
+        src.close(); dest.close()
+
+def _sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""): h.update(chunk)
+    return h.hexdigest()
+
+def list_backups(shop):
+    pattern = re.compile(rf"^{re.escape(shop)}-\d{{8}}-\d{{6}}-\d{{3}}\.db\.gz$")
+    if not os.path.isdir(BACKUP_DIR): return []
+    names = sorted((n for n in os.listdir(BACKUP_DIR) if pattern.match(n)), reverse=True)
+    return [{"file": n, "bytes": os.path.getsize(os.path.join(BACKUP_DIR, n))} for n in names]
+
+def _backup_lock_file(shop):
+    """Open BACKUP_DIR/.<shop>.lock holding an exclusive flock, or None if a backup holds it."""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    f = open(os.path.join(BACKUP_DIR, f".{shop}.lock"), "w")
+    try: fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError: f.close(); return None
+    return f
+
+def _save_backup_status(shop, **values):
+    with get_db(shop) as db:
+        row = db.execute("SELECT value FROM meta WHERE key='backup_status'").fetchone()
+        db.execute("INSERT OR REPLACE INTO meta(key,value) VALUES('backup_status',?)",
+                   (json.dumps({**(json.loads(row[0]) if row else {}), **values}),))
+
+def backup_status(shop):
+    """Last/current backup of a shop as seen by any worker (live page counts only from this one)."""
+    with get_db(shop) as db:
+        row = db.execute("SELECT value FROM meta WHERE key='backup_status'").fetchone()
+    state = json.loads(row[0]) if row else {}
+    if state.get("running"):
+        lock = _backup_lock_file(shop)
+        if lock:   # marked running but nobody holds the lock: that worker died mid-copy
+            lock.close()
+            state.update(running=False, error=state.get("error") or "Interrupted (worker stopped)")
+    return {**state, **backup_progress.get(shop, {})}
+
+def backup_shop(shop):
+    """Take one snapshot of a shop's database and prune old ones. Returns the snapshot info."""
+    lock = _backup_lock_file(shop)
+    if not lock: raise HTTPException(409, "A backup is already running")
+    state = backup_progress[shop] = {"pages_done": 0, "pages_total": 0}
+    try: _save_backup_status(shop, running=True, started_at=datetime.utcnow().isoformat(), worker=WORKER_ID, error=None)
+    except Exception: backup_progress.pop(shop, None); lock.close(); raise
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f")[:-3]
+    name  = f"{shop}-{stamp}.db.gz"
+    path  = os.path.join(BACKUP_DIR, name)
+    tmp   = path[:-3] + ".tmp"
+    t0 = time.time()
+    try:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        _copy_db(shop_db_path(shop), tmp, state)
+        with open(tmp, "rb") as f_in, gzip.open(path + ".part", "wb", compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1 << 20)
+        digest = _sha256_file(path + ".part")
+        os.replace(path + ".part", path)
+        with open(path + ".sha256", "w") as f: f.write(f"{digest}  {name}\n")
+        for old in list_backups(shop)[BACKUP_KEEP:]:
+            for suffix in ("", ".sha256"):
+                try: os.remove(os.path.join(BACKUP_DIR, old["file"] + suffix))
+                except FileNotFoundError: pass
+        info = {"file": name, "bytes": os.path.getsize(path), "sha256": digest,
+                "seconds": round(time.time()-t0, 2), "created_at": stamp}
+        _save_backup_status(shop, running=False, last=info)
+        return info
+    except Exception as e:
+        _save_backup_status(shop, running=False, error=str(e)); raise
+    finally:
+        backup_progress.pop(shop, None)
+        lock.close()
+        for leftover in (tmp, path + ".part"):
+            if os.path.exists(leftover): os.remove(leftover)
+
+def restore_backup(file, shop):
+    """Replace a shop's database with a snapshot after verifying its checksum.
+    Run with the server stopped; the current file is kept as <db>.pre-restore-<time>."""
+    path = file if os.path.isabs(file) or os.path.exists(file) else os.path.join(BACKUP_DIR, file)
+    with open(path + ".sha256") as f: expected = f.read().split()[0]
+    if _sha256_file(path) != expected: raise RuntimeError("Checksum mismatch — snapshot is corrupt")
+    target = shop_db_path(shop)
+    staged = target + ".restore"
+    with gzip.open(path, "rb") as f_in, open(staged, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out, 1 << 20)
+    conn = sqlite3.connect(staged)
+    try:
+        check = conn.execute("PRAGMA quick_check").fetchone()[0]
+        # the snapshot caught its own backup mid-run ("running"); that status means nothing here
+        if check == "ok" and conn.execute("SELECT 1 FROM sqlite_master WHERE name='meta'").fetchone():
+            conn.execute("DELETE FROM meta WHERE key='backup_status'"); conn.commit()
+    finally: conn.close()
+    if check != "ok": os.remove(staged); raise RuntimeError(f"Restored file failed quick_check: {check}")
+    with _pools_lock:
+        pool = _pools.pop(shop, None)
+    if pool: pool.close()
+    response_cache.forget(shop)
+    if os.path.exists(target): os.replace(target, f"{target}.pre-restore-{datetime.utcnow():%Y%m%d-%H%M%S}")
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(target + suffix): os.remove(target + suffix)
+    os.replace(staged, target)
+
+_leader_locks = []
+
+def is_scheduler_leader(name):
+    """True in exactly one worker process: it keeps an exclusive flock on TENANT_DIR/.<name>.lock
+    for its lifetime, so periodic jobs run once even with --workers N."""
+    f = open(os.path.join(TENANT_DIR, f".{name}.lock"), "w")
+    try: fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError: f.close(); return False
+    _leader_locks.append(f)
+    return True
+
+def _backup_scheduler():
+    while True:
+        time.sleep(BACKUP_INTERVAL_MIN * 60)
+        for shop in SHOPS:
+            try: backup_shop(shop)
+            except Exception: pass   # kept in the shop's backup_status
+
+@app.on_event("startup")
+def start_backup_scheduler():
+    if BACKUP_INTERVAL_MIN > 0 and is_scheduler_leader("backup"):
+        threading.Thread(target=_backup_scheduler, name="backup-scheduler", daemon=True).start()
+
+@app.get("/api/admin/backups")
+def get_backups(admin=Depends(require_admin)):
+    shop = current_shop.get()
+    return {"status": backup_status(shop), "backups": list_backups(shop)}
+
+@app.post("/api/admin/backups", status_code=202)
+def trigger_backup(admin=Depends(require_admin)):
+    shop = current_shop.get()
+    if backup_status(shop).get("running"): raise HTTPException(409, "A backup is already running")
+    threading.Thread(target=lambda: backup_shop(shop), name=f"backup-{shop}", daemon=True).start()
+    return {"started": True, "shop": shop}
+
+# ── Background jobs ───────────────────────────────────────────
+# Persistent queue in each shop's `jobs` table. Every worker process runs JOB_WORKERS
+# threads that claim the highest-priority queued job with one atomic UPDATE ... RETURNING,
+# so jobs survive restarts and are never run twice at once. A running job whose heartbeat
+# stops (its process died) is re-queued, up to JOB_MAX_ATTEMPTS.
+JOB_WORKERS        = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_SEC       = 1.0
+JOB_HEARTBEAT_SEC  = 15
+JOB_STALE_SEC      = 60
+JOB_FINISH_RETRIES = 30   # attempts to store a job's outcome while the shop is locked
+JOB_MAX_ATTEMPTS   = 3
+JOB_RETENTION_DAYS = int(os.getenv("JOB_RETENTION_DAYS", "7"))
+EXPORT_DIR         = os.getenv("EXPORT_DIR", os.path.join(TENANT_DIR, "exports"))
+WORKER_ID          = f"{socket.gethostname()}:{os.getpid()}"
+JOB_HANDLERS       = {}       # kind -> fn(ctx) returning a JSON-able result
+_job_wakeup        = threading.Event()
+_job_sweep_at      = [0.0]
+
+class JobCancelled(Exception): pass
+
+def job_handler(kind):
+    def register(fn):
+        JOB_HANDLERS[kind] = fn; return fn
+    return register
+
+class JobContext:
+    """Handed to job handlers: the job's shop/params plus progress reporting."""
+    def __init__(self, shop, job_id, params):
+        self.shop, self.job_id, self.params, self._last = shop, job_id, params, 0.0
+
+    def progress(self, done, total=None, message=None):
+        """Record progress (at most once a second) and raise JobCancelled if cancel was requested."""
+        now = time.time()
+        if now - self._last < 1: return
+        self._last = now
+        pct = round(100*done/total, 1) if total else 0
+        with get_db(self.shop) as db:
+            db.execute("UPDATE jobs SET progress=?, message=COALESCE(?,message), heartbeat_at=? WHERE id=?",
+                (pct, message, now, self.job_id))
+            cancel = db.execute("SELECT cancel_requested FROM jobs WHERE id=?", (self.job_id,)).fetchone()[0]
+        if cancel: raise JobCancelled()
+
+@contextmanager
+def _queue_db(shop):
+    """Short-lived connection for polling a shop's queue. Polling visits every shop each round,
+    so it stays out of the tenant pools (an LRU smaller than SHOPS would reopen and re-migrate
+    them all every second); a shop whose file doesn't exist yet has no jobs and is skipped."""
+    conn = sqlite3.connect(f"file:{quote(os.path.abspath(shop_db_path(shop)))}?mode=rw", uri=True, timeout=1)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+def _claim_job(shop):
+    with _queue_db(shop) as db:
+        # Plain read first (uses the partial queue index, takes no write lock) so idle polling
+        # never competes with till writes; only an actual candidate is claimed with an UPDATE.
+        if not db.execute("SELECT id FROM jobs WHERE status='queued' LIMIT 1").fetchone(): return None
+        row = db.execute(
+            "UPDATE jobs SET status='running', worker=?, heartbeat_at=?, attempts=attempts+1, "
+            "started_at=COALESCE(started_at, datetime('now')) "
+            "WHERE id=(SELECT id FROM jobs WHERE status='queued' ORDER BY priority DESC, id LIMIT 1) RETURNING *",
+            (WORKER_ID, time.time())).fetchone()
+        return dict(row) if row else None
+
+def _sweep_jobs(shop):
+    """Re-queue jobs orphaned by a dead worker and drop finished jobs past retention."""
+    with _queue_db(shop) as db:
+        db.execute("UPDATE jobs SET status='queued', worker=NULL WHERE status='running' AND heartbeat_at < ?",
+            (time.time() - JOB_STALE_SEC,))
+        old = db.execute("SELECT id, result FROM jobs WHERE status IN ('done','failed','cancelled') "
+                         "AND finished_at < datetime('now', ?)", (f"-{JOB_RETENTION_DAYS} days",)).fetchall()
+        for j in old:
+            f = (json.loads(j["result"]) or {}).get("file") if j["result"] else None
+            if f and os.path.exists(f): os.remove(f)
+        db.executemany("DELETE FROM jobs WHERE id=?", [(j["id"],) for j in old])
+
+def _run_job(shop, job):
+    ctx = JobContext(shop, job["id"], json.loads(job["params"] or "{}"))
+    handler = JOB_HANDLERS.get(job["kind"])
+    stop = threading.Event()
+    def heartbeat():
+        while not stop.wait(JOB_HEARTBEAT_SEC):
+            try:
+                with get_db(shop) as db: db.execute("UPDATE jobs SET heartbeat_at=? WHERE id=?", (time.time(), job["id"]))
+            except sqlite3.Error: pass   # busy this beat (VACUUM, long write) — the next one catches up
+    threading.Thread(target=heartbeat, name=f"job-{job['id']}-heartbeat", daemon=True).start()
+    current_shop.set(shop)
+    result = error = None
+    try:
+        if job["attempts"] > JOB_MAX_ATTEMPTS: raise RuntimeError(f"Gave up after {JOB_MAX_ATTEMPTS} attempts")
+        if not handler: raise RuntimeError(f"Unknown job kind '{job['kind']}'")
+        result, status = handler(ctx), "done"
+    except JobCancelled: status = "cancelled"
+    except Exception as e: status, error = "failed", str(e)
+    try:   # the heartbeat keeps running until the outcome is stored, so a retry here can't look stale
+        for attempt in range(JOB_FINISH_RETRIES):
+            try:
+                with get_db(shop) as db:
+                    db.execute("UPDATE jobs SET status=?, result=?, error=?, heartbeat_at=NULL, finished_at=datetime('now'), "
+                               "progress=CASE WHEN ?='done' THEN 100 ELSE progress END WHERE id=?",
+                        (status, json.dumps(result) if result is not None else None, error, status, job["id"]))
+                break
+            except sqlite3.OperationalError:
+                time.sleep(min(2 ** attempt, 10))
+    finally: stop.set()
+
+def _job_worker():
+    while True:
+        if time.time() - _job_sweep_at[0] > JOB_STALE_SEC / 2:
+            _job_sweep_at[0] = time.time()
+            for shop in SHOPS:
+                try: _sweep_jobs(shop)
+                except Exception: pass
+        ran = False
+        for shop in SHOPS:
+            try: job = _claim_job(shop)
+            except sqlite3.OperationalError: continue   # shop busy (or not created yet) — try again next round
+            if job: _run_job(shop, job); ran = True
+        if not ran:
+            _job_wakeup.wait(JOB_POLL_SEC); _job_wakeup.clear()
+
+@app.on_event("startup")
+def start_job_workers():
+    for i in range(JOB_WORKERS):
+        threading.Thread(target=_job_worker, name=f"job-worker-{i}", daemon=True).start()
+
+@job_handler("export")
+def export_job(ctx):
+    """Full export of every business table as gzipped JSON lines, read in small id-ordered chunks
+    so no long read transaction is held."""
+    tables = [t for t in ctx.params.get("tables", CACHED_TABLES) if t in CACHED_TABLES]
+    folder = os.path.join(EXPORT_DIR, ctx.shop); os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"export-{ctx.job_id}-{datetime.utcnow():%Y%m%d-%H%M%S}.jsonl.gz")
+    rows = 0
+    try:
+        with gzip.open(path, "wt", encoding="utf-8") as out:
+            for n, table in enumerate(tables):
+                last = 0
+                while True:
+                    with get_db(ctx.shop) as db:
+                        chunk = db.execute(f"SELECT * FROM {table} WHERE id>? ORDER BY id LIMIT 500", (last,)).fetchall()
+                    if not chunk: break
+                    for r in chunk: out.write(json.dumps({"table": table, "row": dict(r)}) + "\n")
+                    rows += len(chunk); last = chunk[-1]["id"]
+                    ctx.progress(n, len(tables), f"{table}: {rows} rows")
+    except BaseException:
+        if os.path.exists(path): os.remove(path)
+        raise
+    return {"file": path, "rows": rows, "bytes": os.path.getsize(path), "tables": tables}
+
+@job_handler("migrate_order_lines")
+def migrate_order_lines_job(ctx):
+    """Give every legacy single-product sale its order_items line, 500 sales per short transaction."""
+    missing = "NOT EXISTS (SELECT 1 FROM order_items oi WHERE oi.sale_id=s.id)"
+    with get_db(ctx.shop) as db:
+        total = db.execute(f"SELECT COUNT(*) FROM sales s WHERE {missing}").fetchone()[0]
+    done, last = 0, 0
+    while True:
+        with get_db(ctx.shop) as db:
+            ids = [r[0] for r in db.execute(f"SELECT id FROM sales s WHERE id>? AND {missing} ORDER BY id LIMIT 500", (last,))]
+            if not ids: break
+            db.execute("INSERT INTO order_items(sale_id,product_id,product_name,qty,unit,unit_price,total,created_at) "
+                       f"SELECT id,product_id,product_name,qty,unit,unit_price,total,created_at FROM sales s "
+                       f"WHERE id IN ({','.join('?'*len(ids))}) AND {missing}", ids)
+        done, last = done + len(ids), ids[-1]
+        ctx.progress(done, total, f"{done}/{total} sales")
+    with get_db(ctx.shop) as db:
+        db.execute("INSERT OR REPLACE INTO meta(key,value) VALUES('order_lines_migrated', datetime('now'))")
+    return {"migrated": done}
+
+@job_handler("backup")
+def backup_job(ctx):
+    return backup_shop(ctx.shop)
+
+def _job_row(r):
+    j = dict(r)
+    j["params"] = json.loads(j["params"] or "{}")
+    j["result"] = json.loads(j["result"]) if j["result"] else None
+    return j
+
+def queue_job(kind, params, priority, user):
+    """Queue a job in the current shop and wake the workers. Returns the job row."""
+    with get_db() as db:
+        cur = db.execute("INSERT INTO jobs(kind,params,priority,added_by) VALUES(?,?,?,?)",
+            (kind, json.dumps(params or {}), max(-10, min(10, priority)), user["id"]))
+        db.commit()
+        job = _job_row(db.execute("SELECT * FROM jobs WHERE id=?", (cur.lastrowid,)).fetchone())
+    _job_wakeup.set()
+    return job
+
+@app.post("/api/jobs", status_code=202)
+def submit_job(data:JobCreate, admin=Depends(require_admin)):
+    if data.kind not in JOB_HANDLERS: raise HTTPException(400, f"Unknown job kind. Use one of: {', '.join(JOB_HANDLERS)}")
+    return queue_job(data.kind, data.params, data.priority, admin)
+
+@app.get("/api/jobs")
+def list_jobs(status:Optional[str]=None, limit:int=50, admin=Depends(require_admin)):
+    where, args = ("WHERE status=?", (status,)) if status else ("", ())
+    with get_db() as db:
+        return [_job_row(r) for r in db.execute(f"SELECT * FROM jobs {where} ORDER BY id DESC LIMIT ?",
+                                                args + (max(1, min(limit, 500)),)).fetchall()]
+
+@app.get("/api/jobs/{jid}")
+def get_job(jid:int, admin=Depends(require_admin)):
+    with get_db() as db:
+        r = db.execute("SELECT * FROM jobs WHERE id=?", (jid,)).fetchone()
+        if not r: raise HTTPException(404,"Not found")
+        return _job_row(r)
+
+@app.post("/api/jobs/{jid}/cancel")
+def cancel_job(jid:int, admin=Depends(require_admin)):
+    """Queued jobs are cancelled at once; running jobs stop at their next progress report."""
+    with get_db() as db:
+        r = db.execute("SELECT status FROM jobs WHERE id=?", (jid,)).fetchone()
+        if not r: raise HTTPException(404,"Not found")
+        if r["status"] == "queued":
+            db.execute("UPDATE jobs SET status='cancelled', finished_at=datetime('now') WHERE id=?", (jid,))
+        elif r["status"] == "running":
+            db.execute("UPDATE jobs SET cancel_requested=1 WHERE id=?", (jid,))
+        else: raise HTTPException(400, f"Job already {r['status']}")
+        db.commit()
+        return _job_row(db.execute("SELECT * FROM jobs WHERE id=?", (jid,)).fetchone())
+
+@app.get("/api/jobs/{jid}/download")
+def download_job_result(jid:int, admin=Depends(require_admin)):
+    job = get_job(jid, admin)
+    f = (job["result"] or {}).get("file")
+    if job["status"] != "done" or not f or not os.path.exists(f): raise HTTPException(404, "No file for this job")
+    return FileResponse(f, filename=os.path.basename(f))
+
+# ── Integrity checks ──────────────────────────────────────────
+# Verifies derived columns against their source rows: sale/purchase paid, due and status
+# against payment rows, sale totals against order lines, raw_items.available against
+# purchases minus ingredients, and flags negative product stock. Each table is read in
+# id-range chunks, INTEGRITY_WORKERS at a time, on read-only connections — every chunk is one
+# short statement, so no long read transaction pins the WAL. With repair, payment columns
+# and raw-item stock are recomputed in a short write per chunk; totals are only reported.
+INTEGRITY_CHUNK   = int(os.getenv("INTEGRITY_CHUNK", "2000"))
+INTEGRITY_WORKERS = int(os.getenv("INTEGRITY_WORKERS", "4"))
+INTEGRITY_SAMPLES = 50
+MONEY_EPS         = 0.005
+
+def _ro_conn(shop):
+    conn = sqlite3.connect(f"file:{quote(os.path.abspath(shop_db_path(shop)))}?mode=ro", uri=True, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def _payment_issues(table, rows):
+    issues = []
+    for r in rows:
+        paid  = r["expected_paid"]
+        total = r["lines_total"] if r["lines"] else r["total"]   # order lines are the source of a sale's total
+        expected = {"total": total, "paid_amount": paid, "due_amount": max(0, total - paid),
+                    "payment_status": "paid" if paid >= total else ("partial" if paid > 0 else "unpaid")}
+        for field, want in expected.items():
+            have = r[field]
+            if want != have if field == "payment_status" else abs((want or 0) - (have or 0)) > MONEY_EPS:
+                issues.append({"table": table, "id": r["id"], "field": field, "stored": have, "expected": want})
+    return issues
+
+def _check_sales(conn, lo, hi):
+    return _payment_issues("sales", conn.execute("""
+        SELECT s.id, s.total, s.paid_amount, s.due_amount, s.payment_status,
+               COALESCE(p.paid, 0) as expected_paid, l.lines_total, COALESCE(l.n, 0) as lines
+        FROM sales s
+        LEFT JOIN (SELECT sale_id, SUM(amount) as paid FROM sale_payments WHERE sale_id BETWEEN :lo AND :hi GROUP BY sale_id) p
+               ON p.sale_id = s.id
+        LEFT JOIN (SELECT sale_id, SUM(total) as lines_total, COUNT(*) as n FROM order_items WHERE sale_id BETWEEN :lo AND :hi GROUP BY sale_id) l
+               ON l.sale_id = s.id
+        WHERE s.id BETWEEN :lo AND :hi""", {"lo": lo, "hi": hi}).fetchall())
+
+def _check_purchases(conn, lo, hi):
+    return _payment_issues("purchases", conn.execute("""
+        SELECT pu.id, pu.total, pu.paid_amount, pu.due_amount, pu.payment_status,
+               COALESCE(p.paid, 0) as expected_paid, NULL as lines_total, 0 as lines
+        FROM purchases pu
+        LEFT JOIN (SELECT purchase_id, SUM(amount) as paid FROM purchase_payments WHERE purchase_id BETWEEN :lo AND :hi
+                   GROUP BY purchase_id) p ON p.purchase_id = pu.id
+        WHERE pu.id BETWEEN :lo AND :hi""", {"lo": lo, "hi": hi}).fetchall())
+
+def _check_raw_items(conn, lo, hi):
+    return [{"table": "raw_items", "id": r["id"], "field": "available", "stored": r["available"], "expected": r["expected"]}
+            for r in conn.execute(f"SELECT id, available, {RAW_AVAILABLE_SQL.format(name='raw_items.name')} as expected "
+                                  "FROM raw_items WHERE id BETWEEN ? AND ?", (lo, hi))
+            if abs(r["available"] - r["expected"]) > MONEY_EPS]
+
+def _check_products(conn, lo, hi):
+    # No stock movement history exists to rebuild qty_available from, so only impossible values are flagged
+    return [{"table": "products", "id": r["id"], "field": "qty_available", "stored": r["qty_available"], "expected": ">= 0"}
+            for r in conn.execute("SELECT id, qty_available FROM products WHERE id BETWEEN ? AND ? AND qty_available < 0", (lo, hi))]
+
+INTEGRITY_CHECKS = {"sales": _check_sales, "purchases": _check_purchases,
+                    "raw_items": _check_raw_items, "products": _check_products}
+PAYMENT_SOURCES  = {"sales": ("sale_payments", "sale_id"), "purchases": ("purchase_payments", "purchase_id")}
+
+def _repair(db, table, issues):
+    """Recompute repairable columns for the rows in `issues` from current source rows. Rows whose
+    total disagrees with their lines are left for review. Returns rows changed."""
+    held = {i["id"] for i in issues if i["field"] == "total"}
+    ids = sorted({i["id"] for i in issues if i["field"] in ("paid_amount", "due_amount", "payment_status", "available")} - held)
+    if not ids: return 0
+    marks = ",".join("?" * len(ids))
+    if table in PAYMENT_SOURCES:
+        src, fk = PAYMENT_SOURCES[table]
+        db.execute(f"UPDATE {table} SET paid_amount=(SELECT COALESCE(SUM(amount),0) FROM {src} WHERE {fk}={table}.id) "
+                   f"WHERE id IN ({marks})", ids)
+        return db.execute(f"UPDATE {table} SET due_amount=MAX(0, total-paid_amount), payment_status=CASE "
+                          "WHEN paid_amount>=total THEN 'paid' WHEN paid_amount>0 THEN 'partial' ELSE 'unpaid' END "
+                          f"WHERE id IN ({marks})", ids).rowcount
+    if table == "raw_items":
+        return db.execute(f"UPDATE raw_items SET available={RAW_AVAILABLE_SQL.format(name='raw_items.name')} "
+                          f"WHERE id IN ({marks})", ids).rowcount
+    return 0
+
+@job_handler("integrity")
+def integrity_job(ctx):
+    """params: tables (default all checks), repair (default false). Writes every issue to a
+    gzipped JSON-lines report and returns counts plus a sample."""
+    tables = [t for t in ctx.params.get("tables", INTEGRITY_CHECKS) if t in INTEGRITY_CHECKS]
+    repair = bool(ctx.params.get("repair"))
+    conn = _ro_conn(ctx.shop)
+    try:
+        tasks = []
+        for t in tables:
+            lo, hi = conn.execute(f"SELECT MIN(id), MAX(id) FROM {t}").fetchone()
+            if lo is not None: tasks += [(t, a, a + INTEGRITY_CHUNK - 1) for a in range(lo, hi + 1, INTEGRITY_CHUNK)]
+    finally:
+        conn.close()
+    local, conns = threading.local(), []
+    def run(task):
+        if not hasattr(local, "conn"):
+            local.conn = _ro_conn(ctx.shop); conns.append(local.conn)
+        return task, INTEGRITY_CHECKS[task[0]](local.conn, task[1], task[2])
+    folder = os.path.join(EXPORT_DIR, ctx.shop); os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"integrity-{ctx.job_id}-{datetime.utcnow():%Y%m%d-%H%M%S}.jsonl.gz")
+    by_field, samples, repaired = {}, [], 0
+    ex = ThreadPoolExecutor(max_workers=INTEGRITY_WORKERS, thread_name_prefix="integrity")
+    try:
+        with gzip.open(path, "wt", encoding="utf-8") as out:
+            for done, ((table, lo, hi), issues) in enumerate(ex.map(run, tasks), 1):
+                for i in issues:
+                    out.write(json.dumps(i) + "\n")
+                    key = f"{i['table']}.{i['field']}"
+                    by_field[key] = by_field.get(key, 0) + 1
+                samples += issues[:INTEGRITY_SAMPLES - len(samples)]
+                if repair and issues:
+                    with get_db(ctx.shop) as db: repaired += _repair(db, table, issues)
+                ctx.progress(done, len(tasks), f"{table} {lo}-{hi}: {sum(by_field.values())} issues so far")
+    except BaseException:
+        ex.shutdown(wait=False, cancel_futures=True)
+        if os.path.exists(path): os.remove(path)
+        raise
+    finally:
+        ex.shutdown()
+        for c in conns: c.close()
+    return {"file": path, "tables": tables, "chunks": len(tasks), "issues": sum(by_field.values()),
+            "by_field": by_field, "repaired": repaired, "samples": samples}
+
+# ── Storage maintenance ───────────────────────────────────────
+# Shop databases use auto_vacuum=INCREMENTAL, so pages freed by deletes sit on the freelist
+# until given back. The maintenance leader visits each shop every MAINT_INTERVAL_MIN and,
+# only if nobody wrote during the last VACUUM_IDLE_SEC, returns up to VACUUM_STEP_PAGES pages
+# per short step, stopping as soon as another connection commits. It also checkpoints the WAL
+# (TRUNCATE once it passes WAL_MAX_MB) and refreshes planner statistics every ANALYZE_HOURS.
+MAINT_INTERVAL_MIN = int(os.getenv("MAINT_INTERVAL_MIN", "5"))       # 0 disables the scheduler
+VACUUM_IDLE_SEC    = float(os.getenv("VACUUM_IDLE_SEC", "2"))
+VACUUM_STEP_PAGES  = int(os.getenv("VACUUM_STEP_PAGES", "256"))
+VACUUM_MAX_STEPS   = 200
+ANALYZE_HOURS      = int(os.getenv("ANALYZE_HOURS", "24"))
+AUTO_VACUUM_MODES  = {0: "none", 1: "full", 2: "incremental"}
+
+def _maint_conn(shop):
+    conn = sqlite3.connect(shop_db_path(shop), timeout=0.2, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def _set_meta(conn, **values):
+    conn.executemany("INSERT OR REPLACE INTO meta(key,value) VALUES(?,?)", [(f"maint_{k}", json.dumps(v)) for k, v in values.items()])
+    conn.commit()
+
+def _wal_bytes(shop):
+    try: return os.path.getsize(shop_db_path(shop) + "-wal")
+    except OSError: return 0
+
+def maintain_shop(shop, force=False):
+    """One maintenance pass over a shop. Returns what was done. `force` refreshes statistics
+    regardless of ANALYZE_HOURS; vacuum steps always wait for an idle database."""
+    done = {"shop": shop, "vacuumed_pages": 0}
+    conn = _maint_conn(shop)
+    try:
+        dv = conn.execute("PRAGMA data_version").fetchone()[0]
+        time.sleep(VACUUM_IDLE_SEC)
+        done["idle"] = conn.execute("PRAGMA data_version").fetchone()[0] == dv
+        if done["idle"] and conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            for _ in range(VACUUM_MAX_STEPS):
+                free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if not free: break
+                # executescript steps the pragma to completion; execute() would free a single page
+                try: conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})")
+                except sqlite3.OperationalError: break       # busy: a writer showed up
+                done["vacuumed_pages"] += free - conn.execute("PRAGMA freelist_count").fetchone()[0]
+                dv = conn.execute("PRAGMA data_version").fetchone()[0]
+                time.sleep(0.05)
+                if conn.execute("PRAGMA data_version").fetchone()[0] != dv: break
+        mode = "TRUNCATE" if done["vacuumed_pages"] or _wal_bytes(shop) > WAL_MAX_BYTES else "PASSIVE"
+        busy, log, ckpt = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+        done["checkpoint"] = {"mode": mode, "busy": busy, "wal_pages": log, "checkpointed": ckpt}
+        last = conn.execute("SELECT value FROM meta WHERE key='maint_analyzed_at'").fetchone()
+        if force or not last or time.time() - json.loads(last[0]) > ANALYZE_HOURS * 3600:
+            conn.executescript("PRAGMA analysis_limit=400; ANALYZE; PRAGMA optimize;")
+            _set_meta(conn, analyzed_at=time.time())
+            done["analyzed"] = True
+        _set_meta(conn, last_pass={**done, "at": datetime.utcnow().isoformat()})
+        return done
+    finally:
+        conn.close()
+
+def _maintenance_scheduler():
+    while True:
+        time.sleep(MAINT_INTERVAL_MIN * 60)
+        for shop in SHOPS:
+            if not os.path.exists(shop_db_path(shop)): continue
+            try: maintain_shop(shop)
+            except sqlite3.Error: pass   # retried next interval
+
+@app.on_event("startup")
+def start_maintenance_scheduler():
+    if MAINT_INTERVAL_MIN > 0 and is_scheduler_leader("maintenance"):
+        threading.Thread(target=_maintenance_scheduler, name="maintenance-scheduler", daemon=True).start()
+
+@job_handler("compact")
+def compact_job(ctx):
+    """Full VACUUM, switching the file to auto_vacuum=INCREMENTAL on the way. Holds the write lock
+    for its duration, so it only runs when an admin queues it, once per legacy file."""
+    conn = _maint_conn(ctx.shop)
+    conn.execute("PRAGMA busy_timeout=30000")
+    try:
+        before = os.path.getsize(shop_db_path(ctx.shop))
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return {"bytes_before": before, "bytes_after": os.path.getsize(shop_db_path(ctx.shop)),
+                "auto_vacuum": AUTO_VACUUM_MODES[conn.execute("PRAGMA auto_vacuum").fetchone()[0]]}
+    finally:
+        conn.close()
+
+@app.get("/api/admin/storage")
+def get_storage_stats(admin=Depends(require_admin)):
+    shop = current_shop.get()
+    with get_db() as db:
+        p = {k: db.execute(f"PRAGMA {k}").fetchone()[0] for k in ("page_size","page_count","freelist_count","auto_vacuum")}
+        try:
+            tables = [dict(r) for r in db.execute(
+                "SELECT name, pageno as pages, pgsize as bytes FROM dbstat WHERE aggregate=TRUE ORDER BY pgsize DESC")]
+        except sqlite3.OperationalError: tables = None   # SQLite built without dbstat
+        maint = {r["key"][6:]: json.loads(r["value"]) for r in db.execute("SELECT * FROM meta WHERE key LIKE 'maint!_%' ESCAPE '!'")}
+    return {"shop": shop, "file_bytes": os.path.getsize(shop_db_path(shop)), "wal_bytes": _wal_bytes(shop),
+            "wal_max_bytes": WAL_MAX_BYTES, **p, "free_bytes": p["freelist_count"]*p["page_size"],
+            "auto_vacuum": AUTO_VACUUM_MODES.get(p["auto_vacuum"]), "compact_needed": p["auto_vacuum"] != 2,
+            "tables": tables, "maintenance": maint}
+
+@job_handler("maintain")
+def maintain_job(ctx):
+    return maintain_shop(ctx.shop, force=True)
+
+@app.post("/api/admin/storage/maintain", status_code=202)
+def run_maintenance(admin=Depends(require_admin)):
+    """Queue a maintenance pass (poll it at /api/jobs/{id}) instead of waiting for the scheduler."""
+    return queue_job("maintain", {}, 5, admin)
+
 @app.get("/health")
 def health():
     return {"status":"ok","version":"3.1","language":"Python 🐍","time":datetime.utcnow().isoformat()}
@@ -924,5 +2768,19 @@ def run_query(req:QueryRequest):
     if req.password!=ADMIN_PASSWORD: return {"error":"Wrong password"}
     if not req.sql.strip().upper().startswith(("SELECT","PRAGMA","WITH")): return {"error":"Only SELECT allowed"}
     try:
-        with get_db() as db: return {"rows":[dict(r) for r in db.execute(req.sql).fetchall()]}
+        with get_db(check_shop(req.shop)) as db: return {"rows":[dict(r) for r in db.execute(req.sql).fetchall()]}
+    except HTTPException: raise   # unknown shop / time budget exceeded
     except Exception as e: return {"error":str(e)}
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="TradDesk maintenance commands")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("backup", help="take a snapshot now")
+    b.add_argument("--shop", default=MAIN_SHOP)
+    r = sub.add_parser("restore", help="restore a snapshot (stop the server first)")
+    r.add_argument("file"); r.add_argument("--shop", default=MAIN_SHOP)
+    args = ap.parse_args()
+    shop = check_shop(args.shop)
+    if args.cmd == "backup": print(backup_shop(shop))
+    else: restore_backup(args.file, shop); print(f"Restored {args.file} into {shop_db_path(shop)}")
@@ -0,0 +1,75 @@
+"""Throughput vs. uvicorn worker count.
+
+Starts the API with --workers N for each N given, on a fresh database each time, then
+drives it from CLIENTS threads for SECONDS with a till-like mix: mostly catalog / dues
+reads plus order creation. Prints requests per second per worker count.
+
+    python tests/bench_workers.py                  # workers 1 and 2, 30 clients, 15s
+    python tests/bench_workers.py 1 2 4 --clients 60 --seconds 30 --writes 0.3
+
+Run from backend/. Scaling needs as many CPU cores as workers; on one core the numbers
+stay flat, which is expected.
+"""
+import argparse, json, os, random, socket, subprocess, sys, tempfile, time, urllib.request, urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+READS   = ["/api/products", "/api/customers", "/api/analytics/dues", "/api/analytics/inventory", "/api/analytics/summary"]
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0)); return s.getsockname()[1]
+
+def _call(base, method, path, token=None, body=None):
+    req = urllib.request.Request(base + path, method=method, data=json.dumps(body).encode() if body is not None else None,
+                                 headers={"Content-Type": "application/json", **({"Authorization": f"Bearer {token}"} if token else {})})
+    try:
+        with urllib.request.urlopen(req, timeout=30) as r: return r.status, json.loads(r.read() or b"null")
+    except urllib.error.HTTPError as e: return e.code, None
+
+def _start(workers, port, data_dir):
+    env = {**os.environ, "DB_PATH": os.path.join(data_dir, "tradesk.db"), "BACKUP_INTERVAL_MIN": "0", "MAINT_INTERVAL_MIN": "0"}
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(workers),
+                             "--log-level", "warning"], cwd=BACKEND, env=env)
+    for _ in range(200):
+        try:
+            if _call(f"http://127.0.0.1:{port}", "GET", "/health")[0] == 200: return proc
+        except OSError: pass
+        time.sleep(0.1)
+    proc.kill(); raise RuntimeError("server did not start")
+
+def run(workers, clients, seconds, writes):
+    port, data_dir = _free_port(), tempfile.mkdtemp(prefix="tradesk-bench-")
+    proc = _start(workers, port, data_dir)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        token = _call(base, "POST", "/api/auth/register", body={"name": "bench", "email": "bench@example.com", "password": "bench123"})[1]["token"]
+        pid = _call(base, "POST", "/api/products", token, {"name": "Tea", "defined_price": 2, "qty_available": 10**9})[1]["id"]
+        order = {"date": "2026-01-01", "customer_name": "Walk-in", "items": [{"product_id": pid, "product_name": "Tea", "qty": 1, "unit_price": 2}]}
+        stop_at = time.time() + seconds
+        def client(_):
+            ok = err = 0
+            while time.time() < stop_at:
+                status = (_call(base, "POST", "/api/orders", token, order) if random.random() < writes
+                          else _call(base, "GET", random.choice(READS), token))[0]
+                if status < 400: ok += 1
+                else: err += 1
+            return ok, err
+        with ThreadPoolExecutor(clients) as ex: results = list(ex.map(client, range(clients)))
+        ok, err = sum(r[0] for r in results), sum(r[1] for r in results)
+        return {"workers": workers, "ok": ok, "errors": err, "req_per_sec": round(ok / seconds, 1)}
+    finally:
+        proc.terminate(); proc.wait(10)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("workers", nargs="*", type=int, default=[1, 2])
+    ap.add_argument("--clients", type=int, default=30)
+    ap.add_argument("--seconds", type=float, default=15)
+    ap.add_argument("--writes", type=float, default=0.2, help="share of requests that create an order")
+    args = ap.parse_args()
+    base = None
+    for n in args.workers:
+        r = run(n, args.clients, args.seconds, args.writes)
+        base = base or r["req_per_sec"]
+        print(f"workers={r['workers']:<3} {r['req_per_sec']:>8} req/s  ok={r['ok']} errors={r['errors']}  x{r['req_per_sec']/base:.2f}")
@@ -0,0 +1,20 @@
+import os, sys, tempfile
+
+# main reads its configuration at import time: point it at a throwaway data directory first
+_data = tempfile.mkdtemp(prefix="tradesk-test-")
+os.environ.update(DB_PATH=os.path.join(_data, "tradesk.db"), BACKUP_INTERVAL_MIN="0", MAINT_INTERVAL_MIN="0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from fastapi.testclient import TestClient
+import main
+
+@pytest.fixture(scope="session")
+def client():
+    return TestClient(main.app)
+
+@pytest.fixture(scope="session")
+def admin(client):
+    """Auth headers of the first registered user, who becomes the shop's admin."""
+    token = client.post("/api/auth/register", json={"name": "Admin", "email": "admin@example.com", "password": "secret1"}).json()["token"]
+    return {"Authorization": f"Bearer {token}"}
@@ -0,0 +1,64 @@
+import sqlite3, subprocess, sys, threading, time
+import main
+
+HOLD_LOCK = """
+import fcntl, os, sys, time
+f = open(os.path.join(sys.argv[1], ".main.lock"), "w"); fcntl.flock(f, fcntl.LOCK_EX)
+print("locked", flush=True); sys.stdin.read()
+"""
+
+def test_backup_state_is_shared_between_workers(client, admin):
+    info = main.backup_shop("main")
+    status = client.get("/api/admin/backups", headers=admin).json()["status"]
+    assert status["running"] is False and status["last"]["file"] == info["file"]
+    # another worker process holding the shop's backup lock: this one must not start a second copy
+    main._save_backup_status("main", running=True)
+    other = subprocess.Popen([sys.executable, "-c", HOLD_LOCK, main.BACKUP_DIR], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        assert other.stdout.readline().strip() == "locked"
+        assert client.get("/api/admin/backups", headers=admin).json()["status"]["running"] is True
+        assert client.post("/api/admin/backups", headers=admin).status_code == 409
+    finally:
+        other.stdin.close(); other.wait(10)
+    # the lock died with that worker: the stale "running" mark is reported as interrupted
+    status = client.get("/api/admin/backups", headers=admin).json()["status"]
+    assert status["running"] is False and "Interrupted" in status["error"]
+
+def test_backup_under_order_load_restores_consistent_snapshot(admin, monkeypatch):
+    monkeypatch.setattr(main, "BACKUP_STEP_PAGES", 8)   # many short steps, so orders land mid-copy
+    stock = 10**6
+    with main.get_db("main") as db:
+        pid = db.execute("INSERT INTO products(name,defined_price,qty_available) VALUES('Load',1,?)", (stock,)).lastrowid
+        uid = db.execute("SELECT id FROM users LIMIT 1").fetchone()[0]
+    order = main.OrderCreate(date="2026-01-01", customer_name="Walk-in",
+                             items=[{"product_id": pid, "product_name": "Load", "qty": 2, "unit_price": 3}])
+    stop, placed = threading.Event(), []
+    def till():
+        main.current_shop.set("main")
+        while not stop.is_set():
+            with main.get_db("main") as db: main.insert_order(db, order, {"id": uid})
+            placed.append(1)
+    tills = [threading.Thread(target=till) for _ in range(4)]
+    for t in tills: t.start()
+    try:
+        while len(placed) < 20: time.sleep(0.01)
+        before = len(placed)
+        info = main.backup_shop("main")
+        after = len(placed)
+    finally:
+        stop.set()
+        for t in tills: t.join()
+    main.SHOPS.append("restored")
+    try:
+        main.restore_backup(info["file"], "restored")
+        db = sqlite3.connect(main.shop_db_path("restored"))
+        try:
+            assert db.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+            sales, lines, qty = db.execute("SELECT COUNT(DISTINCT s.id), COUNT(oi.id), COALESCE(SUM(oi.qty),0) FROM sales s "
+                                           "JOIN order_items oi ON oi.sale_id=s.id WHERE oi.product_id=?", (pid,)).fetchone()
+            assert before <= sales <= after + 4 and lines == sales   # at most one in-flight order per till
+            assert db.execute("SELECT qty_available FROM products WHERE id=?", (pid,)).fetchone()[0] + qty == stock
+            assert db.execute("SELECT COUNT(*) FROM sales s WHERE total != (SELECT SUM(total) FROM order_items WHERE sale_id=s.id)").fetchone()[0] == 0
+        finally: db.close()
+    finally:
+        main.SHOPS.remove("restored")
@@ -0,0 +1,52 @@
+import asyncio, hashlib, json, time
+import httpx, jwt
+import main
+
+ORDER = {"date": "2026-06-01", "customer_name": "Retry", "items": [{"product_name": "Delivery", "qty": 1, "unit_price": 7}]}
+
+def _sales(client, admin):
+    return [s for s in client.get("/api/sales", headers=admin).json() if s["customer_name"] == "Retry"]
+
+def test_retry_with_the_same_key_replays_the_first_response(client, admin):
+    before = len(_sales(client, admin))
+    first = client.post("/api/orders", headers={**admin, "Idempotency-Key": "replay-1"}, json=ORDER)
+    again = client.post("/api/orders", headers={**admin, "Idempotency-Key": "replay-1"}, json=ORDER)
+    assert first.status_code == again.status_code == 201
+    assert again.headers.get("idempotent-replayed") == "true" and again.json() == first.json()
+    assert len(_sales(client, admin)) == before + 1
+
+def test_reusing_a_key_for_a_different_request_is_rejected(client, admin):
+    client.post("/api/orders", headers={**admin, "Idempotency-Key": "reuse-1"}, json=ORDER)
+    r = client.post("/api/orders", headers={**admin, "Idempotency-Key": "reuse-1"}, json={**ORDER, "customer_name": "Other"})
+    assert r.status_code == 422
+
+def test_a_concurrent_duplicate_waits_for_the_original(client, admin, monkeypatch):
+    insert_order = main.insert_order
+    def slow_insert(db, data, user):
+        time.sleep(0.5); return insert_order(db, data, user)
+    monkeypatch.setattr(main, "insert_order", slow_insert)
+    before = len(_sales(client, admin))
+    async def both():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://t") as ac:
+            send = lambda: ac.post("/api/orders", headers={**admin, "Idempotency-Key": "dup-1"}, json=ORDER)
+            return await asyncio.gather(send(), send())
+    a, b = asyncio.run(both())
+    assert a.status_code == b.status_code == 201 and a.json()["id"] == b.json()["id"]
+    assert sorted(r.headers.get("idempotent-replayed", "") for r in (a, b)) == ["", "true"]
+    assert len(_sales(client, admin)) == before + 1
+
+def test_a_claim_abandoned_by_a_dead_worker_is_taken_over(client, admin, monkeypatch):
+    raw = json.dumps(ORDER).encode()
+    uid = jwt.decode(admin["Authorization"][7:], main._EFFECTIVE_SECRET, algorithms=["HS256"])["id"]
+    headers = {**admin, "Idempotency-Key": "orphan-1", "Content-Type": "application/json"}
+    def pending(age):
+        with main.get_db("main") as db:
+            db.execute("INSERT OR REPLACE INTO idempotency_keys(user_id,key,path,body_hash,created_at) VALUES(?,?,?,?,?)",
+                       (uid, "orphan-1", "/api/orders", hashlib.sha256(raw).hexdigest(), time.time() - age))
+    monkeypatch.setattr(main, "IDEMPOTENCY_WAIT", 0.2)
+    pending(1)   # still within its lease: the original may be running
+    assert client.post("/api/orders", headers=headers, content=raw).status_code == 409
+    pending(main.IDEMPOTENCY_LEASE + 5)
+    taken = client.post("/api/orders", headers=headers, content=raw)
+    assert taken.status_code == 201 and "idempotent-replayed" not in taken.headers
+    assert client.post("/api/orders", headers=headers, content=raw).headers.get("idempotent-replayed") == "true"
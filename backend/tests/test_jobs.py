@@ -0,0 +1,19 @@
+import main
+
+def test_polling_the_queue_leaves_the_tenant_pools_alone(admin, monkeypatch):
+    branches = [f"poll{i}" for i in range(20)]
+    monkeypatch.setattr(main, "SHOPS", main.SHOPS + branches)
+    monkeypatch.setattr(main, "TENANT_POOL_MAX", 16)
+    with main.get_db(branches[0]) as db:   # one branch exists and has a job; the rest have no file yet
+        db.execute("DELETE FROM jobs")
+        jid = db.execute("INSERT INTO jobs(kind,priority) VALUES('export',0) RETURNING id").fetchone()[0]
+    opened = list(main._pools)
+    claimed = []
+    for shop in main.SHOPS:   # one worker round
+        try: main._sweep_jobs(shop); job = main._claim_job(shop)
+        except main.sqlite3.OperationalError: continue
+        if job: claimed.append((shop, job["id"], job["status"]))
+    assert (branches[0], jid, "running") in claimed
+    assert list(main._pools) == opened
+    assert not any(main.os.path.exists(main.shop_db_path(s)) for s in branches[1:])
+    with main.get_db(branches[0]) as db: db.execute("DELETE FROM jobs")
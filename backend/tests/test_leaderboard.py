@@ -0,0 +1,12 @@
+import main
+
+def test_deleting_a_sale_takes_its_lines_off_the_product_leaderboard(client, admin):
+    pid = client.post("/api/products", headers=admin, json={"name": "Kettle", "defined_price": 15, "qty_available": 100}).json()["id"]
+    order = {"date": "2026-02-01", "customer_name": "Board", "items": [{"product_id": pid, "product_name": "Kettle", "qty": 2, "unit_price": 15}]}
+    direct, routed = (client.post("/api/orders", headers=admin, json=order).json()["id"] for _ in range(2))
+    board = lambda: {r["key"]: r for r in client.get("/api/analytics/leaderboard?dim=products&window=all", headers=admin).json()["rows"]}
+    assert board()[str(pid)]["count"] == 2
+    with main.get_db("main") as db: db.execute("DELETE FROM sales WHERE id=?", (direct,))   # lines go by FK cascade
+    assert board()[str(pid)]["amount"] == 30
+    assert client.delete(f"/api/sales/{routed}", headers=admin).status_code == 200           # lines deleted first
+    assert str(pid) not in board()
@@ -0,0 +1,14 @@
+def _open_sale(client, admin, phone, total):
+    return client.post("/api/orders", headers=admin, json={"date": "2026-05-01", "customer_name": "Payer", "customer_phone": phone,
+                       "items": [{"product_name": "Service", "qty": 1, "unit_price": total}]}).json()["id"]
+
+def test_sale_ids_given_as_strings_are_coerced(client, admin):
+    first, second = _open_sale(client, admin, "555-0101", 10), _open_sale(client, admin, "555-0101", 10)
+    r = client.post("/api/customers/payments", headers=admin, json={"customer_phone": "555-0101", "amount": 4,
+                    "date": "2026-05-02", "sale_ids": [str(second)]})
+    assert r.status_code == 201, r.json()
+    sales = {s["id"]: s for s in client.get("/api/sales", headers=admin).json()}
+    assert sales[second]["paid_amount"] == 4 and sales[first]["paid_amount"] == 0
+    bad = client.post("/api/customers/payments", headers=admin, json={"customer_phone": "555-0101", "amount": 1,
+                      "date": "2026-05-02", "sale_ids": ["latest"]})
+    assert bad.status_code == 422
@@ -0,0 +1,9 @@
+def test_product_whose_only_sale_was_returned_can_be_deleted(client, admin):
+    new = lambda name: client.post("/api/products", headers=admin, json={"name": name, "defined_price": 4, "qty_available": 10}).json()["id"]
+    kept, gone = new("Sold"), new("Returned")
+    order = lambda pid: client.post("/api/orders", headers=admin, json={"date": "2026-03-01", "customer_name": "R",
+                                    "items": [{"product_id": pid, "product_name": "x", "qty": 1, "unit_price": 4}]}).json()["id"]
+    order(kept)
+    assert client.post(f"/api/sales/{order(gone)}/return", headers=admin, json={"date": "2026-03-02"}).status_code == 200
+    assert client.delete(f"/api/products/{kept}", headers=admin).status_code == 400
+    assert client.delete(f"/api/products/{gone}", headers=admin).status_code == 200
@@ -0,0 +1,36 @@
+import os, threading, time
+import main
+
+def test_first_account_of_a_branch_needs_the_admin_password(client, monkeypatch):
+    monkeypatch.setattr(main, "SHOPS", main.SHOPS + ["north"])
+    reg = lambda email, **kw: client.post("/api/auth/register", json={"name": "N", "email": email, "password": "secret1", "shop": "north", **kw})
+    assert reg("grab@example.com").status_code == 403
+    assert reg("grab@example.com", admin_password="guess").status_code == 403
+    first = reg("lead@example.com", admin_password=main.ADMIN_PASSWORD)
+    assert first.status_code == 201 and first.json()["user"]["role"] == "admin"
+    assert reg("clerk@example.com").json()["user"]["role"] == "staff"
+
+def test_a_branch_cannot_alias_the_main_database(client, monkeypatch):
+    name = os.path.splitext(os.path.basename(main.DB_PATH))[0]   # "tradesk" -> TENANT_DIR/tradesk.db
+    assert not main.valid_shop_name(name) and main.valid_shop_name("north")
+    monkeypatch.setattr(main, "SHOPS", main.SHOPS + [name])
+    r = client.post("/api/auth/register", json={"name": "X", "email": "x@example.com", "password": "secret1",
+                                                "shop": name, "admin_password": main.ADMIN_PASSWORD})
+    assert r.status_code == 404
+
+def test_a_slow_first_open_only_holds_up_its_own_shop(admin, monkeypatch):
+    monkeypatch.setattr(main, "SHOPS", main.SHOPS + ["slowpoke"])
+    init_db, started = main.init_db, threading.Event()
+    def slow_init(conn):
+        if conn.execute("PRAGMA database_list").fetchone()[2].endswith("slowpoke.db"): started.set(); time.sleep(1)
+        init_db(conn)
+    monkeypatch.setattr(main, "init_db", slow_init)
+    pools = []
+    openers = [threading.Thread(target=lambda: pools.append(main.tenant_pool("slowpoke"))) for _ in range(3)]
+    for t in openers: t.start()
+    started.wait(5)
+    t0 = time.time()
+    with main.get_db("main") as db: db.execute("SELECT 1")
+    assert time.time() - t0 < 0.5
+    for t in openers: t.join()
+    assert len(pools) == 3 and len({id(p) for p in pools}) == 1   # opened (and migrated) once
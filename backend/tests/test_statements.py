@@ -0,0 +1,28 @@
+def test_paged_statement_matches_one_page_and_carries_the_balance(client, admin):
+    phone = "555-0199"
+    for day, price, paid in [("2026-07-01", 50, 10), ("2026-07-01", 20, 0), ("2026-07-03", 30, 30), ("2026-07-05", 40, 5)]:
+        sid = client.post("/api/orders", headers=admin, json={"date": day, "customer_name": "Ledger", "customer_phone": phone, "paid_amount": paid,
+                          "items": [{"product_name": "Work", "qty": 1, "unit_price": price}]}).json()["id"]
+        if day == "2026-07-01" and price == 20:
+            client.post(f"/api/sales/{sid}/payments", headers=admin, json={"amount": 8, "date": "2026-07-04"})
+    get = lambda **q: client.get("/api/statements/customer", headers=admin, params={"customer_phone": phone, **q}).json()
+    full = get(limit=500)
+    assert full["next_cursor"] is None and full["opening_balance"] == 0
+    assert full["closing_balance"] == 50 + 20 + 30 + 40 - (10 + 30 + 5 + 8)
+    running = 0
+    for e in full["entries"]:
+        running += e["debit"] - e["credit"]
+        assert e["balance"] == running
+    assert [e["date"] for e in full["entries"]] == sorted(e["date"] for e in full["entries"])
+    pages, cursor = [], None
+    while True:
+        page = get(limit=2, **({"cursor": cursor} if cursor else {}))
+        pages += page["entries"]; cursor = page["next_cursor"]
+        if not cursor: break
+        assert page["closing_balance"] == page["entries"][-1]["balance"]
+    assert pages == full["entries"]
+    later = get(date_from="2026-07-03")
+    before = [e for e in full["entries"] if e["date"] < "2026-07-03"]
+    assert later["opening_balance"] == before[-1]["balance"]
+    assert later["entries"] == full["entries"][len(before):]
+    assert client.get("/api/statements/customer", headers=admin, params={"customer_phone": phone, "cursor": "garbage"}).status_code == 400
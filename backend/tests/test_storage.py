@@ -0,0 +1,30 @@
+import threading, time
+import main
+
+def _run_queued(shop="main"):
+    job = main._claim_job(shop)
+    main._run_job(shop, job)
+    with main.get_db(shop) as db: return main._job_row(db.execute("SELECT * FROM jobs WHERE id=?", (job["id"],)).fetchone())
+
+def test_manual_maintenance_is_queued_and_still_waits_for_idle(client, admin, monkeypatch):
+    monkeypatch.setattr(main, "VACUUM_IDLE_SEC", 0.3)
+    with main.get_db("main") as db:
+        db.execute("DELETE FROM jobs")
+        db.executemany("INSERT INTO suppliers(name,notes) VALUES(?,?)", [(f"m{i}", "x" * 3000) for i in range(200)])
+    with main.get_db("main") as db: db.execute("DELETE FROM suppliers WHERE name LIKE 'm%'")
+    r = client.post("/api/admin/storage/maintain", headers=admin)
+    assert r.status_code == 202 and r.json()["kind"] == "maintain" and r.json()["status"] == "queued"
+    # a till keeps writing: no vacuum steps, but the pass still checkpoints and analyzes
+    stop = threading.Event()
+    def till():
+        while not stop.is_set():
+            with main.get_db("main") as db: db.execute("INSERT INTO suppliers(name) VALUES('busy')")
+            time.sleep(0.02)
+    t = threading.Thread(target=till); t.start()
+    try: busy = _run_queued()
+    finally: stop.set(); t.join()
+    assert busy["status"] == "done" and busy["result"]["idle"] is False and busy["result"]["vacuumed_pages"] == 0
+    assert busy["result"]["analyzed"] is True
+    client.post("/api/admin/storage/maintain", headers=admin)
+    quiet = _run_queued()
+    assert quiet["result"]["idle"] is True and quiet["result"]["vacuumed_pages"] > 0
@@ -0,0 +1,44 @@
+import main
+
+def _product(client, admin, name, qty=10):
+    return client.post("/api/products", headers=admin, json={"name": name, "defined_price": 5, "qty_available": qty}).json()["id"]
+
+def test_bad_ops_are_reported_per_op_and_the_rest_of_the_batch_applies(client, admin):
+    pid = _product(client, admin, "Sync tea")
+    line = {"product_id": pid, "product_name": "Sync tea", "qty": 1, "unit_price": 5}
+    ops = [
+        {"op_id": "o1", "type": "order", "data": {"date": "2026-04-01", "customer_name": "Till", "items": [line]}},
+        {"op_id": "o2", "type": "sale", "data": {"date": "2026-04-01", "customer_name": "Till", "product_id": 999,
+                                                 "product_name": "Deleted while offline", "qty": 1, "unit_price": 5}},
+        {"op_id": "o3", "type": "order", "data": {"date": "2026-04-01", "customer_name": "Till", "items": ["not an item"]}},
+        {"op_id": "o4", "type": "order", "data": {"date": "2026-04-01", "customer_name": "Till", "items": [{**line, "qty": 50}]}},
+        {"op_id": "o5", "type": "sale_payment", "ref": "o1", "data": {"amount": 2, "date": "2026-04-02"}},
+        {"op_id": "o6", "type": "refund", "data": {}},
+    ]
+    r = client.post("/api/sync", headers=admin, json={"client_id": "till-1", "since": 0, "ops": ops})
+    assert r.status_code == 200
+    res = {x["op_id"]: x for x in r.json()["results"]}
+    assert [res[k]["status"] for k in ("o1", "o2", "o3", "o4", "o5", "o6")] == ["applied", "conflict", "conflict", "conflict", "applied", "error"]
+    assert "999" in res["o2"]["detail"] and "Not enough stock" in res["o4"]["detail"]
+    with main.get_db("main") as db:
+        sale = db.execute("SELECT paid_amount FROM sales WHERE id=?", (res["o1"]["id"],)).fetchone()
+        assert sale["paid_amount"] == 2
+        assert db.execute("SELECT qty_available FROM products WHERE id=?", (pid,)).fetchone()[0] == 9
+
+def test_resent_ops_replay_their_stored_outcome(client, admin):
+    pid = _product(client, admin, "Replay tea")
+    op = {"op_id": "r1", "type": "order", "data": {"date": "2026-04-01", "customer_name": "Till",
+          "items": [{"product_id": pid, "product_name": "Replay tea", "qty": 3, "unit_price": 5}]}}
+    first = client.post("/api/sync", headers=admin, json={"client_id": "till-2", "ops": [op]}).json()["results"][0]
+    again = client.post("/api/sync", headers=admin, json={"client_id": "till-2", "ops": [op]}).json()["results"][0]
+    assert first["status"] == "applied" and again == {**first, "replayed": True}
+    other = client.post("/api/sync", headers=admin, json={"client_id": "till-3", "ops": [op]}).json()["results"][0]
+    assert other["status"] == "applied" and other["id"] != first["id"]   # op ids are per till
+    with main.get_db("main") as db:
+        assert db.execute("SELECT qty_available FROM products WHERE id=?", (pid,)).fetchone()[0] == 4
+
+def test_first_sync_asks_for_a_full_resync(client, admin):
+    _product(client, admin, "Resync tea")
+    r = client.post("/api/sync", headers=admin, json={"client_id": "till-4", "since": 0}).json()
+    assert r["full_resync"] is True and r["version"] > 0
+    assert client.post("/api/sync", headers=admin, json={"client_id": "till-4", "since": r["version"]}).json()["full_resync"] is False
@@ -59,6 +59,8 @@ const fmt = n=>`₹${Number(n||0).toLocaleString("en-IN")}`;
 const payColor = s=>s==="paid"?C.green:s==="partial"?C.orange:C.red;
 const payLabel = s=>s==="paid"?"✓ Paid":s==="partial"?"⏳ Partial":"✗ Unpaid";
 const today = ()=>new Date().toISOString().split("T")[0];
+// Server-hosted images come in fixed sizes (thumb/small/medium/orig); old base64 images pass through
+const imgSize = (src,size)=>src&&src.startsWith("/api/images/")?`${src}?size=${size}`:src;
 const fmtDate = d=>d?new Date(d).toLocaleDateString("en-IN",{day:"2-digit",month:"short",year:"numeric"}):"—";
 
 // ── UI Atoms ──────────────────────────────────────────────────
@@ -126,7 +128,7 @@ const ADMIN_TABS = ["Dashboard","Raw Goods","Products","Orders","Dues","Inventor
 const STAFF_TABS = ["Raw Goods","Products","Orders","Dues","Inventory","Invoices"];
 
 const emptyP = {date:today(),supplier_name:"",item:"",qty:"",unit:"units",unit_cost:"",paid_amount:"",low_stock_alert:""};
-const emptyProd = {name:"",description:"",defined_price:"",unit:"pcs"};
+const emptyProd = {name:"",description:"",defined_price:"",unit:"pcs",low_stock_threshold:""};
 const emptyS = {date:today(),customer_name:"",customer_phone:"",customer_addr:"",product_id:"",product_name:"",qty:"",unit:"pcs",defined_price:0,unit_price:"",paid_amount:""};
 
 export default function Dashboard(){
@@ -144,6 +146,7 @@ export default function Dashboard(){
   const [suppliers,setSuppliers] = useState([]);
   const [customers,setCustomers] = useState([]);
   const [inventory,setInventory] = useState([]);
+  const [alerts,setAlerts]       = useState([]);
   const [summary,setSummary]     = useState({});
   const [monthly,setMonthly]     = useState([]);
   const [users,setUsers]         = useState([]);
@@ -215,15 +218,15 @@ export default function Dashboard(){
         get("/purchases"), get("/products"), get("/sales"),
         get("/analytics/dues"), get("/analytics/purchase-dues"),
         get("/suppliers"), get("/analytics/inventory"),
-        get("/customers"), get("/analytics/return-dues"),
+        get("/customers"), get("/analytics/return-dues"), get("/alerts"),
       ];
       if(isAdmin) calls.push(get("/analytics/summary"), get("/analytics/monthly"), get("/users"));
-      const [p,pr,s,d,pd,sup,inv,cust,rd,...rest] = await Promise.all(calls);
+      const [p,pr,s,d,pd,sup,inv,cust,rd,al,...rest] = await Promise.all(calls);
       setPurchases(Array.isArray(p)?p:[]); setProducts(Array.isArray(pr)?pr:[]);
       setSales(Array.isArray(s)?s:[]); setDues(Array.isArray(d)?d:[]);
       setPurchaseDues(Array.isArray(pd)?pd:[]); setSuppliers(Array.isArray(sup)?sup:[]);
       setInventory(Array.isArray(inv)?inv:[]); setCustomers(Array.isArray(cust)?cust:[]);
-      setReturnDues(Array.isArray(rd)?rd:[]);
+      setReturnDues(Array.isArray(rd)?rd:[]); setAlerts(Array.isArray(al)?al:[]);
       if(isAdmin){ setSummary(rest[0]||{}); setMonthly(Array.isArray(rest[1])?rest[1]:[]); setUsers(Array.isArray(rest[2])?rest[2]:[]); }
     }catch(e){console.error(e);}
     finally{setLoading(false);}
@@ -231,6 +234,23 @@ export default function Dashboard(){
 
   useEffect(()=>{loadAll();},[]);
 
+  // Live low-stock alerts: re-read the small alert list whenever the server reports a crossing
+  useEffect(()=>{
+    const ctrl = new AbortController();
+    (async()=>{
+      try{
+        const r = await fetch(`${BASE}/alerts/stream`,{headers:h(false),signal:ctrl.signal});
+        if(!r.ok||!r.body) return;
+        const reader = r.body.getReader(), dec = new TextDecoder();
+        for(;;){
+          const {done,value} = await reader.read(); if(done) break;
+          if(dec.decode(value).includes("event: alert")){ const al = await get("/alerts"); setAlerts(Array.isArray(al)?al:[]); }
+        }
+      }catch(e){ if(e.name!=="AbortError") console.error(e); }
+    })();
+    return ()=>ctrl.abort();
+  },[]);
+
   // Customer search
   const searchCustomers = async(q)=>{
     setCustSearch(q);
@@ -297,13 +317,14 @@ export default function Dashboard(){
         }
         res = await post("/products/build",{
           ...prodForm,
+          low_stock_threshold:+(prodForm.low_stock_threshold||0),
           defined_price:0,  // backend calculates
           ingredients: prodIngredients.filter(i=>i.item_name).map(i=>({...i,qty:+i.qty,unit_cost:+i.unit_cost})),
           charges: prodCharges.filter(c=>c.label&&c.amount).map(c=>({...c,amount:+c.amount}))
         });
       } else {
         if(!prodForm.defined_price){setError("Price required");setSaving(false);return;}
-        res = await post("/products",{...prodForm,defined_price:+prodForm.defined_price});
+        res = await post("/products",{...prodForm,defined_price:+prodForm.defined_price,low_stock_threshold:+(prodForm.low_stock_threshold||0)});
       }
       if(prodImage) await uploadImage(`/products/${res.id}/image`,prodImage);
       await loadAll();
@@ -473,7 +494,7 @@ export default function Dashboard(){
   const trendData  = monthly.map(m=>({...m,month:new Date(m.month+"-01").toLocaleString("default",{month:"short",year:"2-digit"})}));
   const totalDues  = dues.reduce((a,d)=>a+d.due_amount,0);
   const totalPurchaseDues = purchaseDues.reduce((a,d)=>a+d.due_amount,0);
-  const lowStockItems = inventory.filter(i=>i.is_low);
+  const lowStockItems = alerts;
 
   const saveBtn = (label,fn,color=C.accent)=>(
     <button onClick={fn} disabled={saving} style={{width:"100%",background:color,border:"none",borderRadius:9,padding:12,cursor:"pointer",fontWeight:700,fontSize:14,fontFamily:"'DM Sans',sans-serif",color:color===C.accent?"#0a0a0f":C.text,opacity:saving?0.7:1,marginTop:6}}>
@@ -644,7 +665,7 @@ export default function Dashboard(){
                             onMouseLeave={e=>e.currentTarget.style.background="transparent"}>
                             <td style={{padding:"10px 10px"}}>
                               {p.image_data
-                                ? <img src={p.image_data} alt={p.item} onClick={()=>setLightboxImg(p.image_data)}
+                                ? <img src={imgSize(p.image_data,"thumb")} alt={p.item} onClick={()=>setLightboxImg(imgSize(p.image_data,"medium"))}
                                     style={{width:40,height:40,borderRadius:6,objectFit:"cover",cursor:"pointer",transition:"transform 0.15s"}}
                                     onMouseEnter={e=>e.target.style.transform="scale(1.12)"}
                                     onMouseLeave={e=>e.target.style.transform="scale(1)"}
@@ -736,7 +757,7 @@ export default function Dashboard(){
                             onMouseLeave={e=>e.currentTarget.style.background="transparent"}>
                             <td style={{padding:"8px 10px"}}>
                               {prod.image_data
-                                ? <img src={prod.image_data} alt={prod.name} style={{width:48,height:48,objectFit:"cover",borderRadius:7,border:`1px solid ${C.border}`}}/>
+                                ? <img src={imgSize(prod.image_data,"thumb")} alt={prod.name} style={{width:48,height:48,objectFit:"cover",borderRadius:7,border:`1px solid ${C.border}`}}/>
                                 : <div style={{width:48,height:48,background:C.card2,borderRadius:7,display:"flex",alignItems:"center",justifyContent:"center",color:C.muted,fontSize:10}}>No img</div>}
                             </td>
                             <td style={{padding:"8px 10px",fontFamily:"'Syne',sans-serif",fontWeight:700,color:C.text}}>{prod.name}</td>
@@ -1195,6 +1216,7 @@ export default function Dashboard(){
               <Field label={prodBuildMode?"Qty You're Making (products)":"Qty Available"}><Input type="number" placeholder={prodBuildMode?"1":"0"} value={prodForm.qty_available} onChange={e=>setProdForm(f=>({...f,qty_available:e.target.value}))}/>
                 {prodBuildMode&&<div style={{fontSize:10,color:C.textDim,marginTop:3}}>How many finished products are you making from these materials?</div>}
               </Field>
+              <Field label="Low Stock Alert At"><Input type="number" placeholder="e.g. 5" value={prodForm.low_stock_threshold} onChange={e=>setProdForm(f=>({...f,low_stock_threshold:e.target.value}))}/></Field>
             </div>
 
             {/* BUILDER MODE: ingredients + charges */}
@@ -44,3 +44,17 @@ export const analyticsApi = {
   monthly:   () => request("/analytics/monthly"),
   inventory: () => request("/analytics/inventory"),
 };
+
+// Items currently below their low-stock threshold; GET /alerts/stream pushes each crossing (SSE).
+export const alertsApi = {
+  list:   ()          => request("/alerts"),
+  events: (since = 0) => request(`/alerts/events?since=${since}`),
+};
+
+// Offline queue flush: ops = [{op_id, type, data, ref?}] applied in order server-side;
+// returns per-op results plus rows changed since `since` (store the returned version).
+// full_resync (always on the first flush, since=0) means: reload the full lists, then keep the version.
+export const syncApi = {
+  flush: (clientId, since, ops = []) =>
+    request("/sync", { method: "POST", body: JSON.stringify({ client_id: clientId, since, ops }) }),
+};